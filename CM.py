@@ -46,19 +46,22 @@ import sys
 from math import ceil
 from struct import pack, unpack
 from binascii import hexlify, unhexlify
-from ctypes import *
+from collections import OrderedDict
+from threading import Lock
 
 #AES CTR and ECB modes for LTE crypto are imported from pycrypto
 #AES CMAC mode is implemented here from AES ECB
 try:
     from Crypto.Cipher import AES
+    from Crypto.Util import Counter
+    from Crypto.Util.strxor import strxor
     # filter * export
-    __all__ = ['CryMo', 'AES_3GPP',
-               'EEA2', 'EIA2']
+    __all__ = ['CryMo', 'AES_3GPP', 'KeyCache', 'KeystreamCache',
+               'EEA2', 'EIA2', 'EEA2_batch', 'EIA2_batch',
+               'EEA2_stream', 'EIA2_stream', 'SRB_protect', 'SRB_unprotect']
     with_pycrypto = True
 except ImportError:
-    print('[WNG] [Import] Crypto.Cipher.AES from pycrypto not found\n' \
-           '[-] EEA2 / EIA2 not available')
+    # warned about when AES_3GPP is used (see AES_3GPP.__init__)
     # filter * export
     __all__ = ['CryMo',
                'UEA2', 'UIA2',
@@ -77,6 +80,108 @@ class CryMo(object):
 
 class CMException(Exception):
     pass
+
+# bounded LRU cache for key-dependent material (expanded ciphers, subkeys...)
+class KeyCache(object):
+    '''
+    Least-recently-used cache of values derived from a key
+    .get(key) -> value
+        returns the cached value for key, or builds it with build(key),
+        evicting the least recently used entry when size is reached
+    .clear() empties the cache and resets the hits / misses counters
+    The cache can be shared between threads (values being built outside of
+    its lock, so a missing key can be built twice)
+    '''
+    
+    def __init__(self, build, size=64):
+        self.build = build
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key):
+        with self._lock:
+            val = self._entries.pop(key, None)
+            if val is not None:
+                self.hits += 1
+                self._entries[key] = val
+                return val
+        val = self.build(key)
+        with self._lock:
+            self.misses += 1
+            while self._entries and len(self._entries) >= self.size:
+                self._entries.popitem(last=False)
+            if self.size > 0:
+                self._entries[key] = val
+        return val
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+    
+# bounded LRU cache for AES-CTR keystreams
+class KeystreamCache(object):
+    '''
+    Least-recently-used cache of AES-CTR keystreams, per key and IV (count,
+    bearer and dir), holding up to budget bytes of keystreams
+    .get(key, iv_64h, length) -> keystream
+        returns the first length bytes of the cached keystream, if at least
+        as long, or None
+    .put(key, iv_64h, keystream) keeps the keystream (replacing a shorter
+        one), evicting the least recently used ones past budget
+    .clear() empties the cache and resets the hits / misses counters
+    The cache is disabled while budget is 0, and keystreams longer than
+    budget are not kept; it can be shared between threads
+    '''
+    
+    def __init__(self, budget=0):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key, iv_64h, length):
+        ident = (key, iv_64h)
+        with self._lock:
+            # OrderedDict being pure python, only hits reorder it
+            ks = self._entries.get(ident)
+            if ks is None or len(ks) < length:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries[ident] = self._entries.pop(ident)
+        return ks[:length]
+    
+    def put(self, key, iv_64h, ks):
+        if len(ks) > self.budget:
+            return
+        ident = (key, iv_64h)
+        with self._lock:
+            if ident in self._entries:
+                self.size -= len(self._entries.pop(ident))
+            self._entries[ident] = ks
+            self.size += len(ks)
+            while self.size > self.budget:
+                self.size -= len(self._entries.popitem(last=False)[1])
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
     
 
 ###
@@ -90,11 +195,88 @@ if with_pycrypto:
     AES.key_size = AES_key_size
     AES.block_size = AES_block_size
     aes_ecb = lambda key, data: AES.new(key, AES.MODE_ECB).encrypt(data)
+    # CTR mode with the counter block incremented natively by pycrypto:
+    # iv is the highest 64 bits of the counter block, lowest 64 bits start at 0
+    aes_ctr = lambda key, iv, data: AES.new(key, AES.MODE_CTR, \
+        counter=Counter.new(64, prefix=iv, initial_value=0, \
+                            allow_wraparound=True)).encrypt(data)
+    # XOR of 2 strings, made natively by pycrypto
+    # (truncated to the shortest one for xor_str)
+    xor_str = lambda a, b: strxor(a[:len(b)], b[:len(a)])
+    xor_block = strxor
 #
-xor_str = lambda a, b: ''.join(map(chr, [ord(a[i])^ord(b[i]) for i in \
-                               range(min(len(a), len(b)))] ))
 _pow64 = 0x10000000000000000
 
+# lowest 64 bits of CTR counter blocks, used for generating many counter
+# blocks at once (up to ctr_blocks_max blocks per IV)
+# built once for all, so that it is never modified while in use
+ctr_blocks_max = 4096
+_ctr_low = tuple([pack('!Q', i) for i in range(ctr_blocks_max)])
+
+def ctr_blocks(iv_64h, n):
+    # n successive counter blocks (n <= ctr_blocks_max), with highest 64 bits
+    # iv_64h and lowest 64 bits starting at 0
+    if not n:
+        return ''
+    return iv_64h + iv_64h.join(_ctr_low[:n])
+
+# length of the 1st blocks of CMAC messages up to which they are chained
+# with the cached AES-ECB cipher, cheaper than setting up AES-CBC below 5
+# blocks
+cmac_chain_max = 4*AES_block_size
+
+def trunc_bits(data, bitlen):
+    # truncate data to bitlen bits, zeroing out the unused bits of last byte
+    data = data[:int(ceil(bitlen/8.0))]
+    lastbits = (8-(bitlen%8))%8
+    if lastbits:
+        data = ''.join((data[:-1], \
+                  chr(ord(data[-1:]) & (0x100 - (1<<lastbits))) ))
+    return data
+
+def cmac_key_sched(key):
+    # schedule the key for potential padding
+    # returns the AES-ECB cipher for key, and CMAC subkeys K1, K2
+    ecb = AES.new(key, AES.MODE_ECB)
+    # AES a zero input block
+    L = ecb.encrypt(16*'\0')
+    # schedule depending of the MSB of L
+    # python-fu: unpack the 128 bits register as 2 BE uint64
+    Lh, Ll = unpack('!QQ', L)
+    # sum both uint64 as an uint128, left-shift and filter
+    K1 = (((Lh*_pow64)+Ll) << 1) & 0xffffffffffffffffffffffffffffffff
+    # XOR K1 depending of the MSB of L
+    if Lh & 0x8000000000000000:
+         K1 ^= 0x87
+    # re-shift K1 to make K2
+    K2 = (K1 << 1) & 0xffffffffffffffffffffffffffffffff
+    # XOR K2 depending of the MSB of K1
+    if K1 & 0x80000000000000000000000000000000:
+        K2 ^= 0x87
+    # return 2 corresponding 16-bytes strings K1, K2
+    return ecb, pack('!QQ', K1/_pow64, K1%_pow64), \
+                pack('!QQ', K2/_pow64, K2%_pow64)
+
+def cmac_last_block(Mn, Mnlen, K1, K2):
+    # pad the last block Mn of Mnlen bits and XOR it with the right subkey
+    if Mnlen == AES_block_size*8:
+        # if M is AES blocksize-aligned, XOR Mn with subkey:
+        return xor_block(Mn, K1)
+    # if M not AES blocksize-aligned (or empty, for the NIST
+    # cra$*?* test vectors...):
+    # NIST'way to pad: (Mn*||10^j)^K2, j = n*b-Mlen-1 ...
+    # so... 1st, switch the 1st padding bit to 1 
+    # in the 1st byte with padding, then pad with 0
+    pad_offset = Mnlen/8
+    Mn = ''.join(( \
+        Mn[:pad_offset],
+        chr( ord(Mn[pad_offset:pad_offset+1] or '\0') \
+             + (1 << (8-((Mnlen%8)+1))) ), \
+        '\0' * (AES_block_size-pad_offset-1) ))
+    #print('Mn padded: %s' % hexlify(Mn))
+    # XOR Mn with subkey
+    return xor_block(Mn, K2)
+
 # Define a class for AES_CTR and AES_CMAC as specified in TS 33.401
 # AES_CMAC is defined in NIST 800-38B
 class AES_3GPP(CryMo):
@@ -102,7 +284,8 @@ class AES_3GPP(CryMo):
     LTE 2nd encryption / integrity protection algorithm
     It is AES-based, working with:
         - 128 bits key and 128 bits block
-        - in CTR mode for ciphering (based on pycrypto function)
+        - in CTR mode for ciphering (based on pycrypto function, with native
+          counter increment)
         - in CMAC mode for integrity protection 
           (made from pycrypto AES-ECB function)
     
@@ -121,7 +304,9 @@ class AES_3GPP(CryMo):
         count is uint32 integer (or long, as it is the way python works)
         bearer is unsigned integer limited to LTE bearers (coded on 5 bits)
         dir is 0 or 1 integer depending on uploading or downloading
-        data_in is a variable-length string, to be ciphered / deciphered
+        data_in is a variable-length string, to be ciphered / deciphered,
+            or a read-only buffer (e.g. over a bytearray), ciphered in place
+            of a string without copy
         bitlen is an integer, representing the length of data_in in bits
             optional to pass, depending if data_in is byte aligned
         data_out is the result of ciperhing / deciphering
@@ -135,43 +320,77 @@ class AES_3GPP(CryMo):
         bitlen is uint64 integer, representing the length of data_in in bits
             optional to pass, depending if data_in is byte aligned
         mac is a 4 bytes string
+    For ciphering / deciphering many messages at once:
+    .EEA2_batch(key, counts, bearer, dir, datas, bitlens) -> (out, offsets)
+        key, bearer and dir are given once for all messages,
+            or as lists with one value per message
+        counts is a list of uint32 integers, one per message
+        datas is a list of variable-length strings, to be ciphered / deciphered
+        bitlens is an optional list of data_in lengths in bits
+        out is the concatenation of all data_out, data_out i being
+            out[offsets[i]:offsets[i+1]]
+    For ciphering / MAC computing data of any length, chunk after chunk:
+    .EEA2_stream(key, count, bearer, dir) -> EEA2_Stream
+    .EIA2_stream(key, count, bearer, dir) -> EIA2_Stream
+        both having .update(data_in) and .finalize() methods
+    For protecting / unprotecting SRB PDCP PDUs (MAC-I, then ciphering of
+    the payload and MAC-I):
+    .SRB_protect(key_int, key_enc, count, bearer, dir, pdu, hdrlen) -> pdu_out
+    .SRB_unprotect(key_int, key_enc, count, bearer, dir, pdu, hdrlen)
+        -> (pdu_out, mac, check)
+        key_int and key_enc are the 16 bytes integrity and ciphering keys
+        pdu is the PDU string, starting with its hdrlen bytes header (1 by
+            default) which is not ciphered
+        pdu_out is the protected PDU (with its MAC-I), or the unprotected PDU
+            (without its MAC-I, given apart as mac)
+        check is True when the MAC-I of the unprotected PDU is valid
+    For producing MAC-I of many messages at once:
+    .EIA2_batch(key, counts, bearer, dir, datas, bitlens, macs) -> macs_out
+        key, bearer and dir are given once for all messages,
+            or as lists with one value per message
+        counts is a list of uint32 integers, one per message
+        datas is a list of variable-length strings, to use for MAC computing
+        bitlens is an optional list of data_in lengths in bits
+        macs_out is the concatenation of the 4 bytes MAC of each message
+        if macs (the concatenation of expected MACs) is passed,
+            (macs_out, check) is returned, with check a bytearray bitmap
+            having bit i (MSB first) set when MAC i matches
+    
+    Counters and CMAC chaining are local to each call (or stream object):
+    instances, including the one behind the module EEA2 / EIA2 functions,
+    can be used from several threads at once
     '''
     
     dbg_cmac = 0
     
-    def __counter(self):
-        if not hasattr(self, 'ctr_count'):
-            self.ctr_count = 0
-        else:
-            self.ctr_count += 1
-            if self.ctr_count == _pow64:
-                self.ctr_count = 0
-        cnt = ''.join((self.iv_64h, pack('!Q', self.ctr_count)))
-        #print hexlify(cnt)
-        return cnt
-    
-    def __cmac_key_sched(self, key):
-        # schedule the key for potential padding
-        # AES a zero input block
-        L = aes_ecb(key, 16*'\0')
-        if self.dbg_cmac:
-            print('L: %s' % hexlify(L))
-        # schedule depending of the MSB of L
-        # python-fu: unpack the 128 bits register as 2 BE uint64
-        Lh, Ll = unpack('!QQ', L)
-        # sum both uint64 as an uint128, left-shift and filter
-        K1 = (((Lh*_pow64)+Ll) << 1) & 0xffffffffffffffffffffffffffffffff
-        # XOR K1 depending of the MSB of L
-        if Lh & 0x8000000000000000:
-             K1 ^= 0x87
-        # re-shift K1 to make K2
-        K2 = (K1 << 1) & 0xffffffffffffffffffffffffffffffff
-        # XOR K2 depending of the MSB of K1
-        if K1 & 0x80000000000000000000000000000000:
-            K2 ^= 0x87
-        # return 2 corresponding 16-bytes strings K1, K2
-        return pack('!QQ', K1/_pow64, K1%_pow64), \
-               pack('!QQ', K2/_pow64, K2%_pow64)
+    def __init__(self):
+        if not with_pycrypto:
+            log('WNG', '[Import] Crypto.Cipher.AES from pycrypto not found\n' \
+                '[-] EEA2 / EIA2 not available')
+    
+    # AES-ECB ciphers and CMAC subkeys, cached per key and shared between
+    # all instances: set cmac_cache.size to bound the number of keys kept
+    cmac_cache = KeyCache(cmac_key_sched, 64)
+    # CTR keystreams of EEA2 and SRB PDUs, cached per key, count, bearer and
+    # dir and shared between all instances: disabled until
+    # keystream_cache.budget (in bytes) is set, so that repeated ciphering /
+    # deciphering of the same COUNT turns into a XOR with the cached keystream
+    keystream_cache = KeystreamCache(0)
+    
+    def __ctr(self, key, iv_64h, data):
+        # AES-CTR ciphering of data, with the cached keystream if enabled
+        # (strxor taking neither empty strings nor buffers)
+        cache = self.keystream_cache
+        if not cache.budget or not len(data):
+            return aes_ctr(key, iv_64h, data)
+        data = str(data)
+        ks = cache.get(key, iv_64h, len(data))
+        if ks is not None:
+            return xor_block(data, ks)
+        # the keystream of a miss is got back from its ciphered data
+        ciph = aes_ctr(key, iv_64h, data)
+        cache.put(key, iv_64h, xor_block(data, ciph))
+        return ciph
     
     def AES_CMAC(self, K=16*'\0', M='', Tlen=AES_block_size*8, Mlen=None):
         # prepare bit length
@@ -179,62 +398,43 @@ class AES_3GPP(CryMo):
             Mlen = len(M)*8
         # truncate / zero the message if Mlen is given correctly
         else:
-            M = M[:int(ceil(Mlen/8.0))]
-            lastbits = (8-(Mlen%8))%8
-            if lastbits:
-                M = ''.join((M[:-1], \
-                    chr(ord(M[-1:]) & (0x100 - (1<<lastbits))) ))
-        # define parameters for iterating
-        b = AES_block_size*8
-        # n is useless, as we iterate directly over Mlist:
-        #n = int(ceil(Mlen / float(b))) if Mlen else 1
-        # K1, K2 subkeys
-        K1, K2 = self.__cmac_key_sched(K)
+            M = trunc_bits(M, Mlen)
+        # AES-ECB cipher and K1, K2 subkeys
+        ecb, K1, K2 = self.cmac_cache.get(K)
         if self.dbg_cmac:
             print('K1: %s' % hexlify(K1))
             print('K2: %s' % hexlify(K2))
-        # message divided into blocks of length b, and last Mn taken out
-        Mlist = [M[i:i+AES_block_size] \
-                 for i in range(0, int(ceil(Mlen/8.0)), AES_block_size)]
-        #print Mlist
-        if Mlist:
-            Mn = Mlist.pop()
-            Mnlen = Mlen % b
-            # adjust last block depending of its length
-            if Mnlen:
-                # if M not AES blocksize-aligned:
-                # NIST'way to pad: (Mn*||10^j)^K2, j = n*b-Mlen-1 ...
-                # so... 1st, pad with 0
-                Mn += '\0' * (16-int(ceil(Mnlen/8.0)))
-                # then switch the 1st padding bit to 1 
-                # in the 1st byte with padding
-                pad_offset = Mnlen/8
-                Mn = ''.join(( \
-                    Mn[:pad_offset],
-                    chr( ord(Mn[pad_offset]) + (1 << (8-((Mnlen%8)+1))) ), \
-                    Mn[pad_offset+1:] ))
-                #print('Mn padded: %s' % hexlify(Mn))
-                # XOR Mn with subkey
-                Mn = xor_str(Mn, K2)
-            else:
-                # if M is AES blocksize-aligned, XOR Mn with subkey:
-                Mn = xor_str(Mn, K1)
-        else:
-            # this is for the NIST cra$*?* test vectors...
-            Mn = '\x80\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0'
-            Mn = xor_str(Mn, K2)
-        Mlist.append(Mn)
-        # loop over the message to MAC it
-        C = AES_block_size * '\0'
-        for Mi in Mlist:
-            #print('Mi: %s' % hexlify(Mi))
-            C = aes_ecb(K, xor_str(C, Mi))
+        C = self.__cmac(K, ecb, K1, K2, M, Mlen)
         # if Tlen not byte-aligned, zero out last bits of T
         T = C[:int(ceil(Tlen/8.0))]
         if Tlen%8:
             T = ''.join((T[:-1], chr(ord(T[-1])&(0xff-(1<<(8-(Tlen%8))-1)))))
         return T
     
+    def __cmac(self, K, ecb, K1, K2, M, Mlen):
+        # CMAC the message M of Mlen bits (already truncated), with the
+        # AES-ECB cipher and K1, K2 subkeys scheduled for key K
+        # message divided into blocks of length b, last block Mn taken out
+        Mbytes = int(ceil(Mlen/8.0))
+        Mnoff = ((Mbytes-1)//AES_block_size)*AES_block_size if Mbytes else 0
+        Mn = M[Mnoff:Mbytes]
+        Mnlen = Mlen - Mnoff*8
+        Mn = cmac_last_block(Mn, Mnlen, K1, K2)
+        # chain the 1st blocks of the message, as AES-CBC with a zero IV:
+        # block after block with the cached AES-ECB cipher for short messages,
+        # with a new AES-CBC cipher (and its key expansion) for longer ones
+        if Mnoff > cmac_chain_max:
+            C = AES.new(K, AES.MODE_CBC, AES_block_size*'\0').encrypt( \
+                buffer(M, 0, Mnoff))[-AES_block_size:]
+            Mn = xor_block(C, Mn)
+        elif Mnoff:
+            C = ecb.encrypt(M[:AES_block_size])
+            for i in range(AES_block_size, Mnoff, AES_block_size):
+                C = ecb.encrypt(xor_block(C, M[i:i+AES_block_size]))
+            Mn = xor_block(C, Mn)
+        # MAC the last block
+        return ecb.encrypt(Mn)
+    
     def EEA2(self, key=16*'\0', count=0, bearer=0, dir=0, data='', bitlen=None):
         max32 = pow(2, 32)
         length = len(data)
@@ -247,23 +447,20 @@ class AES_3GPP(CryMo):
             raise(CMException)
         if not isinstance(dir, int) or dir not in (0, 1):
             raise(CMException)
-        if not isinstance(data, str) or length >= 16777216:
+        if not isinstance(data, (str, buffer)) or length >= 16777216:
             raise(CMException)
         if not isinstance(bitlen, int) or bitlen < 0 or bitlen > length*8:
             bitlen = length*8
         # if bitlen is given correctly, truncate data if needed
         else:
             data = data[:int(ceil(bitlen/8.0))]
-        # build IV with highest 64 bits of the CTR counter
-        self.iv_64h = pack('!II', count, (bearer<<27)+(dir<<26))
-        # initialize CTR counter
-        self.ctr_count = -1
-        ciph = AES.new(key, AES.MODE_CTR, counter=self.__counter).encrypt(data)
+        # build IV with highest 64 bits of the CTR counter,
+        # lowest 64 bits are handled by the pycrypto counter (starting at 0)
+        iv_64h = pack('!II', count, (bearer<<27)+(dir<<26))
+        ciph = self.__ctr(key, iv_64h, data)
         # zero out last bits of data if needed
-        lastbits = (8-(bitlen%8))%8
-        if lastbits:
-            ciph = ''.join((ciph[:-1], \
-                      chr(ord(ciph[-1:]) & (0x100 - (1<<lastbits))) ))
+        if bitlen%8:
+            ciph = trunc_bits(ciph, bitlen)
         return ciph
     
     def EIA2(self, key=16*'\0', count=0, bearer=0, dir=0, data='', bitlen=None):
@@ -287,8 +484,235 @@ class AES_3GPP(CryMo):
         # prepare concatenated message:
         M = ''.join(( pack('!II', count, (bearer<<27)+(dir<<26)), data))
         return self.AES_CMAC(key, M, 32, bitlen+64)
+    
+    def __batch_args(self, key, counts, bearer, dir, datas, bitlens):
+        # key, bearer and dir can be given once for the whole batch,
+        # or as a list with one value per data; returns lists for key,
+        # bearer, dir and bitlen, with one value per data
+        max32 = pow(2, 32)
+        num = len(datas)
+        keys = [key]*num if isinstance(key, str) else key
+        bearers = [bearer]*num if isinstance(bearer, int) else bearer
+        dirs = [dir]*num if isinstance(dir, int) else dir
+        if bitlens is None:
+            bitlens = [None]*num
+        # args sanity check, once for all data
+        if len(counts) != num or len(keys) != num or len(bearers) != num \
+        or len(dirs) != num or len(bitlens) != num:
+            raise(CMException)
+        for k in set(keys):
+            if not isinstance(k, str) or len(k) != 16:
+                raise(CMException)
+        for b in set(bearers):
+            if not isinstance(b, int) or b < 0 or b >= 32:
+                raise(CMException)
+        if not set(dirs).issubset((0, 1)):
+            raise(CMException)
+        for count in counts:
+            if not isinstance(count, (int, long)) or count < 0 \
+            or count >= max32:
+                raise(CMException)
+        bitlens = list(bitlens)
+        for i in range(num):
+            data, bitlen = datas[i], bitlens[i]
+            length = len(data)
+            if not isinstance(data, str) or length >= 16777216:
+                raise(CMException)
+            if not isinstance(bitlen, int) or bitlen < 0 \
+            or bitlen > length*8:
+                bitlens[i] = length*8
+        return keys, bearers, dirs, bitlens
+    
+    def EIA2_batch(self, key=16*'\0', counts=[], bearer=0, dir=0, datas=[],
+                   bitlens=None, macs=None):
+        num = len(datas)
+        if macs is not None and len(macs) != 4*num:
+            raise(CMException)
+        keys, bearers, dirs, bitlens = \
+            self.__batch_args(key, counts, bearer, dir, datas, bitlens)
+        out = []
+        for i in range(num):
+            data, Mlen = datas[i], bitlens[i]+64
+            # prepare concatenated message:
+            M = ''.join(( pack('!II', counts[i], \
+                               (bearers[i]<<27)+(dirs[i]<<26)), data))
+            if Mlen < len(M)*8:
+                M = trunc_bits(M, Mlen)
+            ecb, K1, K2 = self.cmac_cache.get(keys[i])
+            out.append(self.__cmac(keys[i], ecb, K1, K2, M, Mlen)[:4])
+        out = ''.join(out)
+        if macs is None:
+            return out
+        # bitmap of MAC checks: bit set (MSB first) when MAC matches
+        check = bytearray((num+7)//8)
+        for i in range(0, 4*num, 4):
+            if out[i:i+4] == macs[i:i+4]:
+                check[i>>5] |= 0x80 >> ((i>>2)&7)
+        return out, check
+    
+    def EEA2_batch(self, key=16*'\0', counts=[], bearer=0, dir=0, datas=[],
+                   bitlens=None):
+        num = len(datas)
+        keys, bearers, dirs, bitlens = \
+            self.__batch_args(key, counts, bearer, dir, datas, bitlens)
+        # group data per key, to cipher all counter blocks of a key at once
+        # with AES-ECB (long data are ciphered on their own in CTR mode)
+        out = [None]*num
+        groups = {}
+        for i in range(num):
+            groups.setdefault(keys[i], []).append(i)
+        for k, idx in groups.items():
+            ecb = self.cmac_cache.get(k)[0]
+            ctr, data = [], []
+            for i in idx:
+                d = datas[i][:int(ceil(bitlens[i]/8.0))]
+                iv_64h = pack('!II', counts[i], (bearers[i]<<27)+(dirs[i]<<26))
+                nblocks = (len(d)+AES_block_size-1)//AES_block_size
+                # nothing to cipher (strxor not taking empty strings)
+                if not nblocks:
+                    out[i] = ''
+                elif nblocks > ctr_blocks_max:
+                    out[i] = aes_ctr(k, iv_64h, d)
+                else:
+                    ctr.append(ctr_blocks(iv_64h, nblocks))
+                    data.append(d)
+            if not ctr:
+                continue
+            # keystream for all data of the group, truncated to each length
+            ks, off, ks_data = ecb.encrypt(''.join(ctr)), 0, []
+            for c, d in zip(ctr, data):
+                ks_data.append(ks[off:off+len(d)])
+                off += len(c)
+            ciph, off = xor_str(''.join(data), ''.join(ks_data)), 0
+            for i in [i for i in idx if out[i] is None]:
+                l = len(datas[i][:int(ceil(bitlens[i]/8.0))])
+                out[i], off = ciph[off:off+l], off+l
+        # zero out last bits of data if needed, and build offsets
+        offsets = [0]
+        for i in range(num):
+            if bitlens[i]%8:
+                out[i] = trunc_bits(out[i], bitlens[i])
+            offsets.append(offsets[-1] + len(out[i]))
+        return ''.join(out), offsets
 
     
+    def EEA2_stream(self, key=16*'\0', count=0, bearer=0, dir=0):
+        return EEA2_Stream(key, count, bearer, dir)
+    
+    def EIA2_stream(self, key=16*'\0', count=0, bearer=0, dir=0):
+        return EIA2_Stream(key, count, bearer, dir)
+    
+    def SRB_protect(self, key_int=16*'\0', key_enc=16*'\0', count=0, bearer=0,
+                    dir=0, pdu='', hdrlen=1):
+        check_srb_args(key_int, key_enc, count, bearer, dir, pdu, hdrlen)
+        # count, bearer and dir make both the 1st block of the MAC-ed message
+        # and the highest 64 bits of the CTR counter
+        iv_64h = pack('!II', count, (bearer<<27)+(dir<<26))
+        M = ''.join((iv_64h, pdu))
+        ecb, K1, K2 = self.cmac_cache.get(key_int)
+        mac = self.__cmac(key_int, ecb, K1, K2, M, len(M)*8)[:4]
+        # cipher the payload and its MAC-I at once
+        return ''.join((pdu[:hdrlen], self.__ctr(key_enc, iv_64h, M[8+hdrlen:] + mac)))
+    
+    def SRB_unprotect(self, key_int=16*'\0', key_enc=16*'\0', count=0, bearer=0,
+                      dir=0, pdu='', hdrlen=1):
+        check_srb_args(key_int, key_enc, count, bearer, dir, pdu, hdrlen+4)
+        iv_64h = pack('!II', count, (bearer<<27)+(dir<<26))
+        plain = self.__ctr(key_enc, iv_64h, buffer(pdu, hdrlen))
+        M = ''.join((iv_64h, pdu[:hdrlen], plain[:-4]))
+        ecb, K1, K2 = self.cmac_cache.get(key_int)
+        mac = self.__cmac(key_int, ecb, K1, K2, M, len(M)*8)[:4]
+        return M[8:], plain[-4:], mac == plain[-4:]
+
+
+def check_stream_args(key, count, bearer, dir):
+    # args sanity check for EEA2 / EIA2 streams
+    if not isinstance(key, str) or len(key) != 16:
+        raise(CMException)
+    if not isinstance(count, (int, long)) or count < 0 or count >= pow(2, 32):
+        raise(CMException)
+    if not isinstance(bearer, int) or bearer < 0 or bearer >= 32:
+        raise(CMException)
+    if not isinstance(dir, int) or dir not in (0, 1):
+        raise(CMException)
+
+def check_srb_args(key_int, key_enc, count, bearer, dir, pdu, minlen):
+    # args sanity check for SRB PDUs protection
+    check_stream_args(key_int, count, bearer, dir)
+    if not isinstance(key_enc, str) or len(key_enc) != 16:
+        raise(CMException)
+    if not isinstance(pdu, str) or len(pdu) < minlen or len(pdu) >= 16777216:
+        raise(CMException)
+
+class EEA2_Stream(CryMo):
+    '''
+    EEA2 ciphering / deciphering of byte-aligned data of any length,
+    passed chunk after chunk, the CTR counter being kept between chunks
+    .update(data_in) -> data_out
+    .finalize() -> '' (nothing is buffered)
+    '''
+    
+    def __init__(self, key=16*'\0', count=0, bearer=0, dir=0):
+        check_stream_args(key, count, bearer, dir)
+        iv_64h = pack('!II', count, (bearer<<27)+(dir<<26))
+        self._ctr = AES.new(key, AES.MODE_CTR, \
+                            counter=Counter.new(64, prefix=iv_64h, \
+                                initial_value=0, allow_wraparound=True))
+        self.length = 0
+    
+    def update(self, data=''):
+        if not isinstance(data, str):
+            raise(CMException)
+        self.length += len(data)
+        return self._ctr.encrypt(data)
+    
+    def finalize(self):
+        return ''
+
+class EIA2_Stream(CryMo):
+    '''
+    EIA2 MAC-I computation over data of any length,
+    passed chunk after chunk, the CMAC chaining being kept between chunks
+    .update(data_in)
+    .finalize(bitlen) -> mac
+        bitlen is the total length of data_in in bits, optional to pass,
+        and can only truncate the last byte of data
+    '''
+    
+    def __init__(self, key=16*'\0', count=0, bearer=0, dir=0):
+        check_stream_args(key, count, bearer, dir)
+        self._key = key
+        self._cbc = AES.new(key, AES.MODE_CBC, AES_block_size*'\0')
+        self._C = AES_block_size*'\0'
+        # message tail not yet chained, starting with count, bearer and dir
+        self._M = pack('!II', count, (bearer<<27)+(dir<<26))
+        self.length = 0
+    
+    def update(self, data=''):
+        if not isinstance(data, str):
+            raise(CMException)
+        self.length += len(data)
+        M = self._M + data
+        # chain all full blocks, but keep the last one for finalize()
+        off = ((len(M)-1)//AES_block_size)*AES_block_size
+        if off:
+            self._C = self._cbc.encrypt(buffer(M, 0, off))[-AES_block_size:]
+            M = M[off:]
+        self._M = M
+    
+    def finalize(self, bitlen=None):
+        Mn = self._M
+        if not isinstance(bitlen, (int, long)) or bitlen < 0 \
+        or bitlen > self.length*8:
+            bitlen = self.length*8
+        elif int(ceil(bitlen/8.0)) != self.length:
+            # data was already chained, cannot be truncated anymore
+            raise(CMException)
+        Mnlen = len(Mn)*8 - (self.length*8 - bitlen)
+        ecb, K1, K2 = AES_3GPP.cmac_cache.get(self._key)
+        Mn = cmac_last_block(trunc_bits(Mn, Mnlen), Mnlen, K1, K2)
+        return ecb.encrypt(xor_block(self._C, Mn))[:4]
+
 #
 ###################
 # DEFINE 3GPP ALG #
@@ -301,4 +725,10 @@ if with_pycrypto:
 if with_pycrypto:
     EEA2 = A.EEA2
     EIA2 = A.EIA2
+    EIA2_batch = A.EIA2_batch
+    EEA2_batch = A.EEA2_batch
+    EEA2_stream = A.EEA2_stream
+    EIA2_stream = A.EIA2_stream
+    SRB_protect = A.SRB_protect
+    SRB_unprotect = A.SRB_unprotect
 #
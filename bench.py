@@ -0,0 +1,202 @@
+__author__ = 'x37liu'
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+from CM import AES_3GPP
+from wrapper import Cipher
+from crypt_bat_bk import AES_Batch
+
+# Benchmarks of AES_3GPP, wrapper.Cipher and batch files, printed as JSON:
+# one result per (bench, size, keys) case, with
+#   ops, ops_s, mb_s, latency percentiles in microseconds (p50, p90, p99, max)
+#   peak_rss_kb: peak memory of the process so far (it never decreases, so
+#   cases are run from the smallest to the biggest)
+
+SIZES = [16, 64, 256, 1 << 10, 4 << 10, 16 << 10, 64 << 10, 256 << 10,
+         1 << 20, 4 << 20, 16 << 20, 64 << 20]
+# EEA2 / EIA2 (and the wrapper) take less than 16MB at once, bigger payloads
+# are run through EEA2_stream / EIA2_stream, by chunks of STREAM_CHUNK bytes
+ONE_SHOT_MAX = (16 << 20) - 1
+STREAM_CHUNK = 1 << 20
+# number of keys of the many-keys cases (more than the CMAC key cache holds)
+MANY_KEYS = 1024
+# sizes of the many-keys cases
+MANY_KEYS_SIZES = [64, 1500]
+# number of rows of the batch file, and size of their data
+BATCH_ROWS = 10000
+BATCH_SIZE = 100
+
+def peakMemory():
+    # peak resident memory in KB (ru_maxrss is in bytes on Mac OS)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+def percentile(values, p):
+    # values being sorted
+    return values[min(int(len(values)*p), len(values) - 1)]
+
+def measure(func, argsList, minTime, minOps=3):
+    # call func(*args) for args cycling through argsList, for at least
+    # minTime seconds and minOps calls, returns the latencies in seconds
+    latencies = []
+    start = time.time()
+    i = 0
+    while len(latencies) < minOps or time.time() - start < minTime:
+        args = argsList[i % len(argsList)]
+        t0 = time.time()
+        func(*args)
+        latencies.append(time.time() - t0)
+        i += 1
+    return latencies
+
+def report(bench, size, keys, latencies, rows=1):
+    # rows: number of operations made by one call
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    ops = len(latencies)*rows
+    return {'bench': bench, 'size': size, 'keys': keys, 'ops': ops,
+            'ops_s': ops/total if total else 0,
+            'mb_s': ops*size/total/(1 << 20) if total else 0,
+            'p50_us': percentile(latencies, 0.5)*1e6,
+            'p90_us': percentile(latencies, 0.9)*1e6,
+            'p99_us': percentile(latencies, 0.99)*1e6,
+            'max_us': latencies[-1]*1e6,
+            'peak_rss_kb': peakMemory()}
+
+def streamEEA2(aes, key, count, bearer, dir, data):
+    stream = aes.EEA2_stream(key, count, bearer, dir)
+    return ''.join([stream.update(data[i:i+STREAM_CHUNK])
+                    for i in range(0, len(data), STREAM_CHUNK)])
+
+def streamEIA2(aes, key, count, bearer, dir, data):
+    stream = aes.EIA2_stream(key, count, bearer, dir)
+    for i in range(0, len(data), STREAM_CHUNK):
+        stream.update(data[i:i+STREAM_CHUNK])
+    return stream.finalize()
+
+def benchCM(sizes, minTime):
+    aes = AES_3GPP()
+    key = os.urandom(16)
+    for size in sizes:
+        data = os.urandom(size)
+        if size > ONE_SHOT_MAX:
+            yield report('EEA2 stream', size, 1,
+                         measure(streamEEA2, [(aes, key, 0x1234, 5, 0, data)], minTime))
+            yield report('EIA2 stream', size, 1,
+                         measure(streamEIA2, [(aes, key, 0x1234, 5, 0, data)], minTime))
+            yield report('AES_CMAC', size, 1, measure(aes.AES_CMAC, [(key, data)], minTime))
+            del data
+            continue
+        yield report('EEA2', size, 1, measure(aes.EEA2, [(key, 0x1234, 5, 0, data)], minTime))
+        # the same count again, with its keystream cached
+        AES_3GPP.keystream_cache.budget = size
+        try:
+            yield report('EEA2 cached', size, 1,
+                         measure(aes.EEA2, [(key, 0x1234, 5, 0, data)], minTime))
+        finally:
+            AES_3GPP.keystream_cache.budget = 0
+            AES_3GPP.keystream_cache.clear()
+        yield report('EIA2', size, 1, measure(aes.EIA2, [(key, 0x1234, 5, 0, data)], minTime))
+        yield report('AES_CMAC', size, 1, measure(aes.AES_CMAC, [(key, data)], minTime))
+        del data
+
+def benchManyKeys(sizes, minTime):
+    aes = AES_3GPP()
+    keys = [os.urandom(16) for i in range(MANY_KEYS)]
+    for size in sizes:
+        data = os.urandom(size)
+        args = [(key, i, i % 32, i % 2, data) for i, key in enumerate(keys)]
+        yield report('EEA2', size, MANY_KEYS, measure(aes.EEA2, args, minTime))
+        yield report('EIA2', size, MANY_KEYS, measure(aes.EIA2, args, minTime))
+
+def benchWrapper(sizes, minTime):
+    cipher = Cipher()
+    key = os.urandom(16).encode('hex')
+    for size in sizes:
+        data = os.urandom(size).encode('hex')
+        yield report('Cipher.encrypt', size, 1,
+                     measure(cipher.encrypt, [(key, 0x1234, 'uplink', 5, data)], minTime))
+        yield report('Cipher.IP', size, 1,
+                     measure(cipher.IP, [(key, 0x1234, 'uplink', 5, data)], minTime))
+        del data
+
+def benchBatch(rows, size, minTime):
+    # batch csv file with rows of Integrity Check / Cipher / Decipher,
+    # with 16 keys, run end to end (csv in, csv out)
+    keys = [os.urandom(16).encode('hex') for i in range(16)]
+    tasks = ['Integrity Check', 'Cipher', 'Decipher']
+    inPath = tempfile.mktemp('.csv')
+    outPath = tempfile.mktemp('.csv')
+    binPath = tempfile.mktemp('.bin')
+    inFile = open(inPath, 'wb')
+    inFile.write('ID,Task,Key,Count,Direction,Bearer,Data,Data Source\r\n')
+    for i in range(rows):
+        inFile.write('%d,%s,%s,%x,%s,%d,%s,s\r\n' % (i, tasks[i % 3], keys[i % 16], i,
+                                                     'uplink' if i % 2 else 'downlink',
+                                                     i % 32, os.urandom(size).encode('hex')))
+    inFile.close()
+    batch = AES_Batch()
+    batch.convert(inPath, binPath)
+    try:
+        for bench, path, grouped in [('batch csv', inPath, False),
+                                     ('batch csv grouped', inPath, True),
+                                     ('batch bin grouped', binPath, True)]:
+            yield report(bench, size, 16,
+                         measure(batch.parseBatch, [(path, outPath, 1, 8, 64 << 20, grouped)],
+                                 minTime, 1), rows)
+    finally:
+        for path in (inPath, outPath, binPath):
+            if os.path.exists(path):
+                os.remove(path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description = 'AES EEA2/EIA2 benchmarks, as JSON.')
+    parser.add_argument('--max-size', type = int, default = SIZES[-1],
+                        help = 'biggest payload in bytes (default 64MB)')
+    parser.add_argument('--min-time', type = float, default = 0.5,
+                        help = 'min seconds spent per case')
+    parser.add_argument('--batch-rows', type = int, default = BATCH_ROWS,
+                        help = 'number of rows of the batch file (0 to skip)')
+    parser.add_argument('--only', type = str, choices = ['cm', 'keys', 'wrapper', 'batch'],
+                        help = 'run only one group of benchmarks')
+    parser.add_argument('--output', type = str, help = 'JSON output path (default stdout)')
+    args = parser.parse_args(argv)
+
+    sizes = [size for size in SIZES if size <= args.max_size]
+    groups = [('cm', lambda: benchCM(sizes, args.min_time)),
+              ('keys', lambda: benchManyKeys(MANY_KEYS_SIZES, args.min_time)),
+              # hex strings are twice as big, and converted back and forth
+              ('wrapper', lambda: benchWrapper([size for size in sizes if size <= ONE_SHOT_MAX],
+                                               args.min_time))]
+    if args.batch_rows > 0:
+        groups.append(('batch', lambda: benchBatch(args.batch_rows, BATCH_SIZE, args.min_time)))
+    results = []
+    for name, bench in groups:
+        if args.only and args.only != name:
+            continue
+        for result in bench():
+            results.append(result)
+            sys.stderr.write('%-18s %9d B %5d keys %12.1f ops/s %9.2f MB/s\n'
+                             % (result['bench'], result['size'], result['keys'],
+                                result['ops_s'], result['mb_s']))
+    out = json.dumps({'python': platform.python_version(),
+                      'platform': platform.platform(),
+                      'peak_rss_kb': peakMemory(),
+                      'results': results}, indent = 1, sort_keys = True)
+    if args.output:
+        outFile = open(args.output, 'w')
+        outFile.write(out + '\n')
+        outFile.close()
+    else:
+        sys.stdout.write(out + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,22 @@
 
 import wx
 import os
+import time
+import threading
 from wrapper import Cipher
 from crypt_bat_bk import AES_Batch
 
+# min delay between 2 progress updates of the window, in seconds
+PROGRESS_DELAY = 0.1
+
 class AES_GUI(wx.Frame):
   
     def __init__(self, parent, title):
         super(AES_GUI, self).__init__(parent, title=title,
-            size=(480, 200))
+            size=(480, 260))
         self.cipher = AES_Batch()
+        self.worker = None
+        self.cancel = threading.Event()
         self.InitUI()
         self.Centre()
         self.Show()     
@@ -41,20 +48,73 @@ class AES_GUI(wx.Frame):
         hbox2.Add(load2, flag=wx.ALIGN_RIGHT|wx.LEFT, border=10)
         vbox.Add(hbox2, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.BOTTOM, border=20)
 
+        hbox_gauge = wx.BoxSizer(wx.HORIZONTAL)
+        self.gauge = wx.Gauge(panel, range=1000)
+        hbox_gauge.Add(self.gauge, proportion=1)
+        self.status = wx.StaticText(panel, label='', size=(160, -1))
+        hbox_gauge.Add(self.status, flag=wx.ALIGN_CENTER|wx.LEFT, border=10)
+        vbox.Add(hbox_gauge, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.BOTTOM, border=20)
+
         hbox3 = wx.BoxSizer(wx.HORIZONTAL)
-        process = wx.Button(panel, label='Process')
-        process.Bind(wx.EVT_BUTTON, self.onProcess)
-        hbox3.Add(process, flag=wx.ALIGN_CENTER|wx.EXPAND, proportion=1)
+        self.process = wx.Button(panel, label='Process')
+        self.process.Bind(wx.EVT_BUTTON, self.onProcess)
+        hbox3.Add(self.process, flag=wx.ALIGN_CENTER|wx.EXPAND, proportion=1)
+        self.cancelBtn = wx.Button(panel, label='Cancel')
+        self.cancelBtn.Bind(wx.EVT_BUTTON, self.onCancel)
+        self.cancelBtn.Disable()
+        hbox3.Add(self.cancelBtn, flag=wx.ALIGN_CENTER|wx.LEFT, border=10)
         vbox.Add(hbox3, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.BOTTOM, border=20)
 
         panel.SetSizer(vbox)
 
     def onProcess(self, event):
-        msg = self.cipher.parseBatch(self.input.GetValue(), self.output.GetValue())
+        # the batch runs in a worker thread, which reports back to the window
+        # with wx.CallAfter
+        if self.worker is not None:
+            return
+        self.cancel.clear()
+        self.gauge.SetValue(0)
+        self.status.SetLabel('')
+        self.process.Disable()
+        self.cancelBtn.Enable()
+        self.worker = threading.Thread(target=self.runBatch,
+                                       args=(self.input.GetValue(), self.output.GetValue()))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def runBatch(self, input, output):
+        start = time.time()
+        last = [0]
+        def progress(done, total):
+            now = time.time()
+            if now - last[0] >= PROGRESS_DELAY or done >= total:
+                last[0] = now
+                wx.CallAfter(self.onProgress, done, total, now - start)
+        try:
+            msg = self.cipher.parseBatch(input, output, progress=progress, cancel=self.cancel)
+        except Exception as err:
+            msg = 'Batch failed: %s \n' % err
+        wx.CallAfter(self.onDone, msg, time.time() - start)
+
+    def onProgress(self, done, total, elapsed):
+        total = max(total, done, 1)
+        self.gauge.SetValue(1000*done//total)
+        rate = done/elapsed if elapsed > 0 else 0
+        self.status.SetLabel('%d/%d rows, %d rows/s' % (done, total, rate))
+
+    def onDone(self, msg, elapsed):
+        self.worker = None
+        self.process.Enable()
+        self.cancelBtn.Disable()
         if not msg == '':
             wx.MessageBox(msg, 'Error', wx.OK | wx.ICON_ERROR)
         else:
-            wx.MessageBox('Completed!', 'Completed', wx.OK | wx.ICON_INFORMATION)
+            self.gauge.SetValue(1000)
+            wx.MessageBox('Completed in %.1fs!' % elapsed, 'Completed', wx.OK | wx.ICON_INFORMATION)
+
+    def onCancel(self, event):
+        self.cancel.set()
+
     def onOpenFile(self, event):
         """
         Create and show the Open FileDialog
@@ -1,67 +1,50 @@
 __author__ = 'x37liu'
 
-import os
 import sys
 import argparse
-import csv
-from wrapper import Cipher
-
-HEADER = ['ID','Task','Key','Count','Direction','Bearer','Data','Data','Source']
+import stats
+from CM import AES_3GPP
+from crypt_bat_bk import AES_Batch, PREFETCH_DEPTH, PREFETCH_BUDGET
 
 def main():
 
     parser = argparse.ArgumentParser(description = 'AES IP/Cipher/Decipher in batch.')
-    parser.add_argument('batch', type = str, help = 'input csv file path')
-    parser.add_argument('output', type = str, help = 'output csv file path')
+    parser.add_argument('batch', type = str, help = 'input csv (or binary) file path')
+    parser.add_argument('output', type = str, help = 'output csv (or binary) file path')
+    parser.add_argument('--workers', type = int, default = 1,
+                        help = 'number of worker processes')
+    parser.add_argument('--prefetch', type = int, default = PREFETCH_DEPTH,
+                        help = 'number of data files read ahead (0 to disable)')
+    parser.add_argument('--prefetch-budget', type = int, default = PREFETCH_BUDGET >> 20,
+                        help = 'max MB of data files kept in memory')
+    parser.add_argument('--group-keys', action = 'store_true',
+                        help = 'process rows grouped by task and key')
+    parser.add_argument('--convert', action = 'store_true',
+                        help = 'convert a batch csv file into a binary batch file, '
+                               'or a binary results file into a csv file')
+    parser.add_argument('--keystream-cache', type = int, default = 0,
+                        help = 'max MB of keystreams kept for rows with the same key, count, '
+                               'bearer and direction (not used with --group-keys)')
+    parser.add_argument('--stats', action = 'store_true',
+                        help = 'report the calls, bytes and time of each stage '
+                               '(of this process only, with --workers 1 for the ciphering)')
     args = parser.parse_args()
+    AES_3GPP.keystream_cache.budget = args.keystream_cache << 20
+    if args.stats:
+        stats.enable()
     parseBatch(args)
+    if args.stats:
+        stats.report(sys.stderr)
 
 def parseBatch(args):
-    outFile = open(args.output, 'wb')
-    writer = csv.writer(outFile)
-    if not os.path.exists(args.batch):
-        sys.stdout.write('Invalid input path! \n')
-        return
-    with open(args.batch, 'rb') as csvfile:
-        reader = csv.reader(csvfile, delimiter = ',')
-        isHead = True
-        for row in reader:
-            if isHead:
-                isHead = False
-                continue
-            id = row[0]
-            task = row[1]
-            key = row[2]
-            cnt = int(row[3], 16)
-            direct = row[4]
-            bearer = int(row[5])
-            source = row[7]
-
-            if source == 'f':
-                if not os.path.exists(row[6]):
-                    sys.stdout.write('Invalid path at task ' + id + '\n')
-                    exit()
-                dataFile = open(row[6], 'r')
-                data = dataFile.read()
-                dataFile.close()
-            elif source == 's':
-                data = row[6]
-            else:
-                sys.stdout.write('Invalid data source ' + id + '\n')
-            print(id + " : " + data)
-
-            cipher = Cipher()
-            if task == 'Integrity Check':
-                out = cipher.IP(key, cnt, direct, bearer, data)
-            elif task == 'Cipher':
-                out = cipher.encrypt(key, cnt, direct, bearer, data)
-            elif task == 'Decipher':
-                out = cipher.decrypt(key, cnt, direct, bearer, data)
-            else:
-                sys.stdout.write('Invalid task ' + id + '\n')
-                exit()
-            writer.writerow((id, out))
-
-    outFile.close()
-
-main()
\ No newline at end of file
+    if args.convert:
+        msg = AES_Batch().convert(args.batch, args.output)
+    else:
+        msg = AES_Batch().parseBatch(args.batch, args.output, args.workers,
+                                     args.prefetch, args.prefetch_budget << 20,
+                                     args.group_keys)
+    if msg:
+        sys.stdout.write(msg)
+
+if __name__ == '__main__':
+    main()
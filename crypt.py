@@ -2,35 +2,125 @@ __author__ = 'x37liu'
 
 import os
 import sys
-import argparse
-from wrapper import Cipher
+import time
 
-def main():
+# modules are imported on first use (see lazyImport), and their import time
+# kept for --startup-profile
+_start = time.time()
+_imports = []
+
+def lazyImport(name):
+    module = sys.modules.get(name)
+    if module is None:
+        t0 = time.time()
+        module = __import__(name)
+        _imports.append((name, time.time() - t0))
+    return module
+
+def getCipher():
+    lazyImport('CM')
+    return lazyImport('wrapper').Cipher()
 
-    # prepare cmd cheat sheet
-    helpFile = open('helpFile', 'r')
+def readHelp():
+    # cmd cheat sheet, next to this script
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'helpFile')
+    if not os.path.exists(path):
+        return None
+    helpFile = open(path, 'r')
     helpStr = helpFile.read()
     helpFile.close()
+    return helpStr
+
+def reportStartup(dst):
+    dst.write('Startup profile (ms):\n')
+    for name, sec in _imports:
+        dst.write('  import %-12s %8.1f\n' % (name, sec*1000))
+    dst.write('  %-19s %8.1f\n' % ('total', (time.time() - _start)*1000))
+
+def main():
+
+    # persistent worker mode, without the single process arguments
+    if '--serve-stdin' in sys.argv[1:]:
+        if '--stats' in sys.argv[1:]:
+            lazyImport('stats').enable()
+        serveStdin(sys.stdin, sys.stdout)
+        if '--stats' in sys.argv[1:]:
+            lazyImport('stats').report(sys.stderr)
+        if '--startup-profile' in sys.argv[1:]:
+            reportStartup(sys.stderr)
+        return
+
+    # the cheat sheet is only needed for the help
+    helpStr = None
+    if '-h' in sys.argv[1:] or '--help' in sys.argv[1:]:
+        helpStr = readHelp()
 
     # read args
+    argparse = lazyImport('argparse')
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description = helpStr)
     parser.add_argument('task',
-                        choices = ['ip', 'ci', 'de'],
+                        choices = ['ip', 'ci', 'de', 'ipci', 'deip'],
                         help = 'Task to complete')
     parser.add_argument('key', type = str, help = 'AES key')
     parser.add_argument('count', type = str, help = 'Count')
-    parser.add_argument('direct', type = str, help = 'Direction')
+    parser.add_argument('direct', choices = ['uplink', 'downlink'], help = 'Direction')
     parser.add_argument('bearer', type = int, help = 'Bearer')
     parser.add_argument('data', type = str, help = 'Stream')
     parser.add_argument('mode', nargs = '?', default='ss',
                         choices = ['ss', 'fs', 'sf', 'ff'],
                         help = 'Data I/O options')
     parser.add_argument('output', nargs = '?', type = str, help = 'Output path')
+    parser.add_argument('--format', default = 'hex',
+                        choices = ['hex', 'bin'],
+                        help = 'Data file format (hex text or raw binary)')
+    parser.add_argument('--ip-key', type = str,
+                        help = 'IP key of the ipci / deip tasks (key being the SRB key)')
+    parser.add_argument('--serve-stdin', action = 'store_true',
+                        help = 'Process requests read from stdin, one per line, as JSON objects '
+                               'or as task,key,count,direction,bearer,data[,ip key]')
+    parser.add_argument('--startup-profile', action = 'store_true',
+                        help = 'Report the import and total times on stderr')
+    parser.add_argument('--stats', action = 'store_true',
+                        help = 'Report the calls, bytes and time of each stage on stderr')
 
     args = parser.parse_args()
 
+    if args.stats:
+        lazyImport('stats').enable()
     parseArgs(args)
+    if args.stats:
+        lazyImport('stats').report(sys.stderr)
+    if args.startup_profile:
+        reportStartup(sys.stderr)
+
+def serveStdin(src, dst):
+    # one result line per request line, JSON for JSON requests and
+    # out[,mac,pass|fail] or ,error for csv ones
+    json = lazyImport('json')
+    handleRequest = lazyImport('crypt_serve').handleRequest
+    cipher = getCipher()
+    fields = ['task', 'key', 'count', 'direction', 'bearer', 'data', 'ip_key']
+    for line in iter(src.readline, ''):
+        line = line.strip()
+        if not line:
+            continue
+        if line[:1] == '{':
+            try:
+                req = json.loads(line)
+            except ValueError:
+                req = None
+            dst.write(json.dumps(handleRequest(cipher, req)) + '\n')
+        else:
+            resp = handleRequest(cipher, dict(zip(fields, line.split(','))))
+            if 'error' in resp:
+                dst.write(',%s\n' % resp['error'])
+            elif 'mac' in resp:
+                dst.write('%s,%s,%s\n' % (resp['out'], resp['mac'],
+                                          'pass' if resp['check'] else 'fail'))
+            else:
+                dst.write('%s\n' % resp['out'])
+        dst.flush()
 
 def output(data, path = ""):
     if path == "":
@@ -43,16 +133,18 @@ def output(data, path = ""):
 
 def parseArgs(args):
     count = int(args.count, 16)
+    if args.task == 'ipci' or args.task == 'deip':
+        parseSRB(args, count)
+        return
     if args.mode == 'ff' or args.mode == 'fs':
         if not os.path.exists(args.data):
             sys.stdout.write('Invalid Data!\n')
             return
-        file = open(args.data, 'r')
-        data = file.read()
-        file.close()
+        parseFile(args, count)
+        return
     else: 
         data = args.data
-    cipher = Cipher()
+    cipher = getCipher()
     out = ""
     if args.task == 'ip':
         out = cipher.IP(args.key, count, args.direct, args.bearer, data)
@@ -62,10 +154,83 @@ def parseArgs(args):
         out = cipher.decrypt(args.key, count, args.direct, args.bearer, data)
     if args.mode == 'ss' or args.mode == 'fs':
         output(out, "")
-    elif args.output:
+        return
+    if args.format == 'bin':
+        out = lazyImport('hexcodec').decode(out)
+    if args.output:
         output(out, args.output)
     else: 
         outPath = raw_input('Please specify output path:')
         output(out, outPath)
-    
-main()
\ No newline at end of file
+
+def parseSRB(args, count):
+    # SRB PDUs protection / unprotection, PDUs being small enough to be
+    # read at once from file
+    if not args.ip_key:
+        sys.stdout.write('IP key required!\n')
+        return
+    if args.mode == 'ff' or args.mode == 'fs':
+        if not os.path.exists(args.data):
+            sys.stdout.write('Invalid Data!\n')
+            return
+        src = open(args.data, 'rb')
+        chunks = lazyImport('wrapper').readData(src, args.format)
+        data = lazyImport('hexcodec').encode(''.join(chunks))
+        src.close()
+    else:
+        data = args.data
+    cipher = getCipher()
+    if args.task == 'ipci':
+        out = cipher.SRB_protect(args.ip_key, args.key, count, args.direct, args.bearer, data)
+    else:
+        out, mac, check = cipher.SRB_unprotect(args.ip_key, args.key, count, args.direct,
+                                               args.bearer, data)
+        if args.mode == 'ss' or args.mode == 'fs':
+            out = '%s %s %s' % (out, mac, 'pass' if check else 'fail')
+        else:
+            sys.stdout.write('%s %s\n' % (mac, 'pass' if check else 'fail'))
+    if args.mode == 'ss' or args.mode == 'fs':
+        output(out, "")
+        return
+    if args.format == 'bin':
+        out = lazyImport('hexcodec').decode(out)
+    if args.output:
+        output(out, args.output)
+    else:
+        outPath = raw_input('Please specify output path:')
+        output(out, outPath)
+
+def parseFile(args, count):
+    # memory-map the data file (ff) or stream it through fixed-size
+    # buffers (fs)
+    cipher = getCipher()
+    if args.task == 'ip':
+        out = cipher.IP_mmap(args.key, count, args.direct, args.bearer, args.data,
+                             inFormat = args.format)
+        if args.mode == 'fs':
+            output(out, "")
+        elif args.output:
+            output(out, args.output)
+        else:
+            outPath = raw_input('Please specify output path:')
+            output(out, outPath)
+        return
+    if args.mode == 'fs':
+        src = open(args.data, 'rb')
+        cipher.encrypt_file(args.key, count, args.direct, args.bearer, src, sys.stdout,
+                            inFormat = args.format)
+        src.close()
+        return
+    if args.output:
+        outPath = args.output
+    else:
+        outPath = raw_input('Please specify output path:')
+    if args.task == 'ci':
+        cipher.encrypt_mmap(args.key, count, args.direct, args.bearer, args.data, outPath,
+                            inFormat = args.format, outFormat = args.format)
+    else:
+        cipher.decrypt_mmap(args.key, count, args.direct, args.bearer, args.data, outPath,
+                            inFormat = args.format, outFormat = args.format)
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -5,15 +5,55 @@
 
 import wx
 import os
+import time
+import tempfile
+import threading
+import hexcodec
+from CM import AES_3GPP
 from wrapper import Cipher
 import webbrowser
 
+# size of the chunks processed between 2 progress updates, in bytes
+CHUNK_SIZE = 1 << 20
+# number of characters of the output shown at once
+PAGE_SIZE = 1 << 16
+# size of the results kept in memory, bigger ones going to a temporary file
+SPOOL_SIZE = 8 << 20
+# size of the data files loaded into the Stream box, bigger ones being
+# read from the file when processing
+LOAD_SIZE = 1 << 20
+# size of the keystreams kept for processing the same count again
+KEYSTREAM_CACHE_SIZE = 16 << 20
+
+class DataFile:
+    # hex data left in its file, decoded by the wrapper / hexcodec
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+
+    def read(self):
+        file = open(self.path, 'r')
+        try:
+            return file.read()
+        finally:
+            file.close()
+
+class Cancelled(Exception):
+    pass
+
 class AES_GUI(wx.Frame):
 
     def __init__(self, parent, title):
+        AES_3GPP.keystream_cache.budget = KEYSTREAM_CACHE_SIZE
         self.cipher = Cipher()
+        self.worker = None
+        self.cancel = threading.Event()
+        # result of the last task, shown page after page
+        self.result = None
+        self.page = 0
+        self.dataFile = None
         super(AES_GUI, self).__init__(parent, title=title,
-            size=(960, 840))
+            size=(960, 920))
 
         self.InitUI()
         self.Centre()
@@ -94,10 +134,35 @@ class AES_GUI(wx.Frame):
         hbox4.Add(self.output, proportion=1,flag=wx.EXPAND|wx.BOTTOM, border=20)
         vbox.Add(hbox4, flag=wx.EXPAND|wx.LEFT|wx.RIGHT, border=20)
 
+        hbox_page = wx.BoxSizer(wx.HORIZONTAL)
+        prev = wx.Button(panel, label='<')
+        prev.Bind(wx.EVT_BUTTON, self.onPrevPage)
+        hbox_page.Add(prev, flag = wx.ALIGN_RIGHT|wx.LEFT, border=52)
+        self.pageLabel = wx.StaticText(panel, label='', size=(120, -1), style=wx.ALIGN_CENTER)
+        hbox_page.Add(self.pageLabel, flag = wx.ALIGN_CENTER|wx.LEFT, border=10)
+        next = wx.Button(panel, label='>')
+        next.Bind(wx.EVT_BUTTON, self.onNextPage)
+        hbox_page.Add(next, flag = wx.ALIGN_RIGHT|wx.LEFT, border=10)
+        save = wx.Button(panel, label='Save Result')
+        save.Bind(wx.EVT_BUTTON, self.onSaveResult)
+        hbox_page.Add(save, flag = wx.ALIGN_RIGHT|wx.LEFT, border=10)
+        vbox.Add(hbox_page, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.BOTTOM, border=20)
+
+        hbox_gauge = wx.BoxSizer(wx.HORIZONTAL)
+        self.gauge = wx.Gauge(panel, range=1000)
+        hbox_gauge.Add(self.gauge, proportion=1, flag=wx.LEFT, border=52)
+        self.status = wx.StaticText(panel, label='', size=(200, -1))
+        hbox_gauge.Add(self.status, flag=wx.ALIGN_CENTER|wx.LEFT, border=10)
+        vbox.Add(hbox_gauge, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.BOTTOM, border=20)
+
         hbox4_btn = wx.BoxSizer(wx.HORIZONTAL)
-        process = wx.Button(panel, label='Process')
-        process.Bind(wx.EVT_BUTTON, self.onProcess)
-        hbox4_btn.Add(process, flag = wx.ALIGN_RIGHT|wx.LEFT, border=52)
+        self.process = wx.Button(panel, label='Process')
+        self.process.Bind(wx.EVT_BUTTON, self.onProcess)
+        hbox4_btn.Add(self.process, flag = wx.ALIGN_RIGHT|wx.LEFT, border=52)
+        self.cancelBtn = wx.Button(panel, label='Cancel')
+        self.cancelBtn.Bind(wx.EVT_BUTTON, self.onCancel)
+        self.cancelBtn.Disable()
+        hbox4_btn.Add(self.cancelBtn, flag = wx.ALIGN_RIGHT|wx.LEFT, border=10)
         copy = wx.Button(panel, label='Copy')
         copy.Bind(wx.EVT_BUTTON, self.onCopy)
         hbox4_btn.Add(copy, flag = wx.ALIGN_RIGHT|wx.LEFT, border=10)
@@ -181,6 +246,10 @@ class AES_GUI(wx.Frame):
         dlg.Destroy()
 
     def onProcess(self, event):
+        # inputs are checked here, the task itself runs in a worker thread
+        # (see start)
+        if self.worker is not None:
+            return
         try:
             task = self.task.GetStringSelection()
             direct = self.direction.GetStringSelection()
@@ -194,71 +263,76 @@ class AES_GUI(wx.Frame):
                 return
             else:
                 bearer = int(self.bearer.GetValue())
-            if (self.data.GetValue()==''):
+            if self.dataFile is not None:
+                data = self.dataFile
+            elif (self.data.GetValue()==''):
                 wx.MessageBox('Data required!', 'Error')
                 return
             else:
-                data = self.data.GetValue().replace('0x', '')
+                data = self.data.GetValue()
 
             if task == 'IP Check':
                 if self.key.GetValue() == '':
                     wx.MessageBox('IP Key required!', 'Error')
                     return
                 else:
-                    key = self.key.GetValue().replace('0x', '')
-                self.output.SetValue(self.cipher.IP(key, count, direct, bearer, data))
+                    key = self.key.GetValue()
+                self.start(lambda progress: self.cipher.IP_chunks(key, count, direct, bearer,
+                                                                  self.feed(data, progress)))
             elif task == 'SRB Cipher':
                 if self.key_SRB.GetValue() == '':
                     wx.MessageBox('SRB Key required!', 'Error')
                     return
                 else:
-                    key = self.key_SRB.GetValue().replace('0x', '')
-                self.output.SetValue(self.cipher.encrypt(key, count, direct, bearer, data))
+                    key = self.key_SRB.GetValue()
+                self.start(lambda progress: self.encrypt(key, count, direct, bearer, data, progress))
             elif task == 'SRB Decipher':
                 if self.key_SRB.GetValue() == '':
                     wx.MessageBox('SRB Key required!', 'Error')
                     return
                 else:
-                    key = self.key_SRB.GetValue().replace('0x', '')
-                self.output.SetValue(self.cipher.decrypt(key, count, direct, bearer, data))
+                    key = self.key_SRB.GetValue()
+                self.start(lambda progress: self.encrypt(key, count, direct, bearer, data, progress))
             elif task == 'DRB Cipher':
                 if self.key_DRB.GetValue() == '':
                     wx.MessageBox('SRB Key required!', 'Error')
                     return
                 else:
-                    key = self.key_DRB.GetValue().replace('0x', '')
-                self.output.SetValue(self.cipher.encrypt(key, count, direct, bearer, data))
-            elif task == 'DRB Cipher':
+                    key = self.key_DRB.GetValue()
+                self.start(lambda progress: self.encrypt(key, count, direct, bearer, data, progress))
+            elif task == 'DRB Decipher':
                 if self.key_DRB.GetValue() == '':
                     wx.MessageBox('SRB Key required!', 'Error')
                     return
                 else:
-                    key = self.key_DRB.GetValue().replace('0x', '')
-                self.output.SetValue(self.cipher.decrypt(key, count, direct, bearer, data))
+                    key = self.key_DRB.GetValue()
+                self.start(lambda progress: self.encrypt(key, count, direct, bearer, data, progress))
             elif task == 'IP + SRB Cipher':
                 if self.key.GetValue() == '':
                     wx.MessageBox('IP Key required!', 'Error')
                     return
                 else:
-                    key_IP = self.key.GetValue().replace('0x', '')
+                    key_IP = self.key.GetValue()
                 if self.key_SRB.GetValue() == '':
                     wx.MessageBox('SRB Key required!', 'Error')
                     return
                 else:
-                    key_RSB = self.key_SRB.GetValue().replace('0x', '')
-                self.output.SetValue(self.RSB_Cipher(key_IP, key_RSB, count, direct, bearer, data))
+                    key_RSB = self.key_SRB.GetValue()
+                self.start(lambda progress: self.RSB_Cipher(key_IP, key_RSB, count, direct, bearer,
+                                                            self.text(data)))
             elif task == 'SRB Decipher + IP':
                 if self.key.GetValue() == '':
                     wx.MessageBox('IP Key required!', 'Error')
                     return
                 else:
-                    key_IP = self.key.GetValue().replace('0x', '')
+                    key_IP = self.key.GetValue()
                 if self.key_SRB.GetValue() == '':
                     wx.MessageBox('SRB Key required!', 'Error')
                     return
                 else:
-                    key_RSB = self.key_SRB.GetValue().replace('0x', '')
-                self.output.SetValue(self.RSB_Decipher(key_IP, key_RSB, count, direct, bearer, data))
+                    key_RSB = self.key_SRB.GetValue()
+                self.start(lambda progress: self.RSB_Decipher(key_IP, key_RSB, count, direct, bearer,
+                                                              self.text(data)))
             else:
                 wx.MessageBox('Task invalid!', 'Error')
                 return
@@ -266,25 +340,163 @@ class AES_GUI(wx.Frame):
             wx.MessageBox("Invalid input!", "Error")
             return
 
+    def start(self, job):
+        # run job(progress) in a worker thread, its result (a string or hex
+        # chunks) being shown in the output box once done
+        self.cancel.clear()
+        self.gauge.SetValue(0)
+        self.status.SetLabel('')
+        self.process.Disable()
+        self.cancelBtn.Enable()
+        self.worker = threading.Thread(target=self.runJob, args=(job,))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def runJob(self, job):
+        start = time.time()
+        def progress(done, total):
+            wx.CallAfter(self.onProgress, done, total, time.time() - start)
+        result = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        try:
+            out = job(progress)
+            if isinstance(out, basestring):
+                out = [out]
+            for chunk in out:
+                result.write(chunk)
+            msg = ''
+        except Cancelled:
+            msg = 'Cancelled!'
+        except Exception:
+            msg = 'Invalid input!'
+        if msg:
+            result.close()
+            result = None
+        wx.CallAfter(self.onDone, result, msg)
+
+    def feed(self, data, progress):
+        # yield the binary chunks of the hex data, reporting progress after
+        # each one, until cancelled
+        if isinstance(data, DataFile):
+            src = open(data.path, 'rb')
+            try:
+                for chunk in hexcodec.decodeFile(src, 2*CHUNK_SIZE):
+                    if self.cancel.is_set():
+                        raise Cancelled()
+                    yield chunk
+                    progress(src.tell(), data.size)
+            finally:
+                src.close()
+            return
+        data = hexcodec.decode(data)
+        for pos in range(0, len(data), CHUNK_SIZE):
+            if self.cancel.is_set():
+                raise Cancelled()
+            yield data[pos:pos+CHUNK_SIZE]
+            progress(min(pos+CHUNK_SIZE, len(data)), len(data))
+
+    def text(self, data):
+        if isinstance(data, DataFile):
+            return data.read()
+        return data
+
+    def encrypt(self, key, count, direct, bearer, data, progress):
+        # data of the Stream box ciphered at once, with the keystream cache
+        if not isinstance(data, DataFile) and len(data) <= 2*CHUNK_SIZE:
+            return self.cipher.encrypt(key, count, direct, bearer, data)
+        return (hexcodec.encode(out) for out in
+                self.cipher.encrypt_chunks(key, count, direct, bearer,
+                                           self.feed(data, progress)))
+
+    def onProgress(self, done, total, elapsed):
+        self.gauge.SetValue(1000*done//max(total, 1))
+        rate = done/elapsed/(1 << 20) if elapsed > 0 else 0
+        self.status.SetLabel('%d/%d bytes, %.1f MB/s' % (done, total, rate))
+
+    def onDone(self, result, msg):
+        self.worker = None
+        self.process.Enable()
+        self.cancelBtn.Disable()
+        if msg:
+            wx.MessageBox(msg, "Error")
+            return
+        self.gauge.SetValue(1000)
+        self.setResult(result)
+
+    def setResult(self, result):
+        if self.result is not None:
+            self.result.close()
+        self.result = result
+        self.page = 0
+        self.showPage()
+
+    def pages(self):
+        if self.result is None:
+            return 0
+        self.result.seek(0, os.SEEK_END)
+        return max((self.result.tell() + PAGE_SIZE - 1)//PAGE_SIZE, 1)
+
+    def showPage(self):
+        # only the current page of the result goes into the output box
+        if self.result is None:
+            self.output.SetValue('')
+            self.pageLabel.SetLabel('')
+            return
+        self.result.seek(self.page*PAGE_SIZE)
+        self.output.SetValue(self.result.read(PAGE_SIZE))
+        self.pageLabel.SetLabel('Page %d/%d' % (self.page + 1, self.pages()))
+
+    def onPrevPage(self, event):
+        if self.page > 0:
+            self.page -= 1
+            self.showPage()
+
+    def onNextPage(self, event):
+        if self.page + 1 < self.pages():
+            self.page += 1
+            self.showPage()
+
+    def onSaveResult(self, event):
+        if self.result is None:
+            wx.MessageBox('No result to save!', 'Error')
+            return
+        dlg = wx.FileDialog(
+            self, message="Save result as ...",
+            defaultDir=os.curdir,
+            defaultFile="", wildcard="All files (*.*)|*.*", style=wx.SAVE
+            )
+        if dlg.ShowModal() == wx.ID_OK:
+            dst = open(dlg.GetPath(), 'wb')
+            self.result.seek(0)
+            for chunk in iter(lambda: self.result.read(CHUNK_SIZE), ''):
+                dst.write(chunk)
+            dst.close()
+        dlg.Destroy()
+
+    def onCancel(self, event):
+        self.cancel.set()
+
     def RSB_Cipher(self, key_IP, key_RSB, count, direct, bearer, data):
-        mac_i = self.cipher.IP(key_IP, count, direct, bearer, data)
-        ciphered = self.cipher.encrypt(key_RSB, count, direct, bearer, data[2:]+mac_i)
-        return data[:2] + " " + ciphered[:-8] + " " + ciphered[-8:]
+        ciphered = self.cipher.SRB_protect(key_IP, key_RSB, count, direct, bearer, data)
+        return ciphered[:2] + " " + ciphered[2:-8] + " " + ciphered[-8:]
 
     def RSB_Decipher(self, key_IP, key_RSB, count, direct, bearer, data):
-        deciphered = self.cipher.decrypt(key_RSB, count, direct, bearer, data[2:])
-        ip = self.cipher.IP(key_IP, count, direct, bearer, data[:2]+deciphered[:-8])
-        if ip == deciphered[-8:]:
+        deciphered, mac_i, check = self.cipher.SRB_unprotect(key_IP, key_RSB, count, direct,
+                                                             bearer, data)
+        if check:
             ip_check = 'pass'
         else:
             ip_check = 'fail'
-        return data[:2] + "  " + deciphered[:-8] + " " + deciphered[-8:] + " " + ip_check
+        return deciphered[:2] + "  " + deciphered[2:] + " " + mac_i + " " + ip_check
 
     def onClear(self, event):
-        for ctrlText in [self.key, self.cnt, self.bearer, self.data, self.output]:
+        for ctrlText in [self.key, self.cnt, self.bearer]:
             ctrlText.SetValue('')
+        self.onClearData(event)
+        self.setResult(None)
 
     def onClearData(self, event):
+        self.dataFile = None
+        self.data.SetEditable(True)
         self.data.SetValue('')
 
     def onOpenFile(self, event):
@@ -297,15 +509,27 @@ class AES_GUI(wx.Frame):
             style=wx.OPEN | wx.CHANGE_DIR
             )
         if dlg.ShowModal() == wx.ID_OK:
+            self.onClearData(event)
             file = open(dlg.GetPath(), 'r')
-            self.data.SetValue(file.read())
+            if os.path.getsize(dlg.GetPath()) > LOAD_SIZE:
+                # big files are read when processing, the Stream box only
+                # shows their beginning
+                self.dataFile = DataFile(dlg.GetPath())
+                self.data.SetValue(file.read(PAGE_SIZE) + '\n...\n[%s, %d bytes]'
+                                   % (self.dataFile.path, self.dataFile.size))
+                self.data.SetEditable(False)
+            else:
+                self.data.SetValue(file.read())
             file.close()
         dlg.Destroy()
 
     def onCopy(self, event):
         """"""
         self.dataObj = wx.TextDataObject()
-        self.dataObj.SetText(self.output.GetValue())
+        if self.result is None:
+            return
+        self.result.seek(0)
+        self.dataObj.SetText(self.result.read())
         if wx.TheClipboard.Open():
             wx.TheClipboard.SetData(self.dataObj)
             wx.TheClipboard.Close()
@@ -0,0 +1,225 @@
+__author__ = 'x37liu'
+
+import sys
+import mmap
+import struct
+from array import array
+
+# Binary batch / results files:
+# header: magic (4 bytes), version (uint16), reserved (uint16),
+#         number of rows (uint32), offset of the columns (uint64)
+# blob:   one payload per row, each prefixed with its length (uint32)
+# columns, one value per row, one column after the other:
+#   batch:   ID (uint32), task (uint8), key (16 bytes), IP key (16 bytes),
+#            count (uint32), direction (uint8), bearer (uint8)
+#   results: ID (uint32), status (uint8)
+# all integers are little-endian
+#
+# a batch row with an invalid task has its error message as payload,
+# so is a result row with an error status, but for a failed integrity check
+# which keeps its output
+
+BATCH_MAGIC = 'CMBB'
+RESULTS_MAGIC = 'CMBR'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIQ')
+LENGTH = struct.Struct('<I')
+
+TASKS = ['Integrity Check', 'Cipher', 'Decipher', 'IP + SRB Cipher',
+         'SRB Decipher + IP', 'DRB Cipher', 'DRB Decipher']
+# tasks with 2 keys, given as (IP key, SRB key)
+SRB_TASKS = ('IP + SRB Cipher', 'SRB Decipher + IP')
+INVALID_TASK = 0xff
+
+# results status
+OK, ERROR, MAC_FAILED = 0, 1, 2
+MAC_FAILED_MSG = 'Integrity check failed'
+
+def fileType(path):
+    # return the magic of a binary batch / results file, or ''
+    with open(path, 'rb') as binFile:
+        magic = binFile.read(4)
+    if magic in (BATCH_MAGIC, RESULTS_MAGIC):
+        return magic
+    return ''
+
+def toFile(col):
+    if sys.byteorder == 'big' and col.itemsize > 1:
+        col = array(col.typecode, col)
+        col.byteswap()
+    return col.tostring()
+
+def fromFile(typecode, data):
+    col = array(typecode, data)
+    if sys.byteorder == 'big' and col.itemsize > 1:
+        col.byteswap()
+    return col
+
+class BinWriter:
+    # payloads are written as rows are added, columns when closing
+
+    def __init__(self, path, magic):
+        self.file = open(path, 'wb')
+        self.magic = magic
+        self.rows = 0
+        self.file.write(HEADER.pack(magic, VERSION, 0, 0, 0))
+
+    def addPayload(self, data):
+        self.file.write(LENGTH.pack(len(data)))
+        self.file.write(data)
+        self.rows += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def writeColumns(self, columns):
+        offset = self.file.tell()
+        for col in columns:
+            self.file.write(col if isinstance(col, str) else toFile(col))
+        self.file.seek(0)
+        self.file.write(HEADER.pack(self.magic, VERSION, 0, self.rows, offset))
+        self.file.close()
+
+class BatchWriter(BinWriter):
+
+    def __init__(self, path):
+        BinWriter.__init__(self, path, BATCH_MAGIC)
+        self.ids = array('I')
+        self.tasks = array('B')
+        self.keys = []
+        self.ipKeys = []
+        self.counts = array('I')
+        self.directs = array('B')
+        self.bearers = array('B')
+
+    def add(self, id, task, key, count, direct, bearer, data, err=''):
+        # add a binary row, an invalid one being stored with its error message
+        if not err:
+            if task not in TASKS:
+                err = 'Invalid task'
+            elif task in SRB_TASKS:
+                if not isinstance(key, tuple) or len(key[0]) != 16:
+                    err = 'Invalid parameters'
+                else:
+                    ipKey, key = key
+            else:
+                ipKey = 16*'\0'
+            if not err and (len(key) != 16 or not 0 <= count < 1 << 32
+                            or direct not in (0, 1) or not 0 <= bearer < 32):
+                err = 'Invalid parameters'
+        self.ids.append(int(id))
+        if err:
+            self.tasks.append(INVALID_TASK)
+            self.keys.append(16*'\0')
+            self.ipKeys.append(16*'\0')
+            self.counts.append(0)
+            self.directs.append(0)
+            self.bearers.append(0)
+            self.addPayload(err)
+            return
+        self.tasks.append(TASKS.index(task))
+        self.keys.append(key)
+        self.ipKeys.append(ipKey)
+        self.counts.append(count)
+        self.directs.append(direct)
+        self.bearers.append(bearer)
+        self.addPayload(data)
+
+    def close(self):
+        self.writeColumns([self.ids, self.tasks, ''.join(self.keys), ''.join(self.ipKeys),
+                           self.counts, self.directs, self.bearers])
+
+class ResultsWriter(BinWriter):
+
+    def __init__(self, path):
+        BinWriter.__init__(self, path, RESULTS_MAGIC)
+        self.ids = array('I')
+        self.status = array('B')
+
+    def add(self, id, out, err=''):
+        self.ids.append(int(id))
+        if err == MAC_FAILED_MSG and out is not None:
+            self.status.append(MAC_FAILED)
+            self.addPayload(out)
+        elif err:
+            self.status.append(ERROR)
+            self.addPayload(err)
+        else:
+            self.status.append(OK)
+            self.addPayload(out)
+
+    def close(self):
+        self.writeColumns([self.ids, self.status])
+
+def openBin(path, magic):
+    # memory-map a binary file, returns (map, number of rows, columns offset)
+    binFile = open(path, 'rb')
+    try:
+        binMap = mmap.mmap(binFile.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        binFile.close()
+    fileMagic, version, reserved, rows, offset = HEADER.unpack_from(binMap, 0)
+    if fileMagic != magic or version != VERSION:
+        binMap.close()
+        raise ValueError('Invalid binary file')
+    return binMap, rows, offset
+
+def countRows(path):
+    # number of rows of a binary batch / results file
+    with open(path, 'rb') as binFile:
+        return HEADER.unpack(binFile.read(HEADER.size))[3]
+
+def readPayloads(binMap, rows):
+    # yield the payload of each row
+    pos = HEADER.size
+    for i in xrange(rows):
+        length = LENGTH.unpack_from(binMap, pos)[0]
+        pos += LENGTH.size
+        yield binMap[pos:pos+length]
+        pos += length
+
+def readBatch(path):
+    # yield the binary rows (id, task, key, count, direct, bearer, data, error)
+    # of a binary batch file
+    binMap, rows, offset = openBin(path, BATCH_MAGIC)
+    try:
+        ids = fromFile('I', binMap[offset:offset+4*rows])
+        offset += 4*rows
+        tasks = fromFile('B', binMap[offset:offset+rows])
+        offset += rows
+        keys = binMap[offset:offset+16*rows]
+        offset += 16*rows
+        ipKeys = binMap[offset:offset+16*rows]
+        offset += 16*rows
+        counts = fromFile('I', binMap[offset:offset+4*rows])
+        offset += 4*rows
+        directs = fromFile('B', binMap[offset:offset+rows])
+        offset += rows
+        bearers = fromFile('B', binMap[offset:offset+rows])
+        for i, data in enumerate(readPayloads(binMap, rows)):
+            if tasks[i] == INVALID_TASK:
+                yield (str(ids[i]), None, None, None, None, None, None, data)
+                continue
+            task = TASKS[tasks[i]]
+            key = keys[16*i:16*i+16]
+            if task in SRB_TASKS:
+                key = (ipKeys[16*i:16*i+16], key)
+            yield (str(ids[i]), task, key, counts[i], directs[i], bearers[i], data, '')
+    finally:
+        binMap.close()
+
+def readResults(path):
+    # yield the results (id, out, error) of a binary results file
+    binMap, rows, offset = openBin(path, RESULTS_MAGIC)
+    try:
+        ids = fromFile('I', binMap[offset:offset+4*rows])
+        status = fromFile('B', binMap[offset+4*rows:offset+5*rows])
+        for i, data in enumerate(readPayloads(binMap, rows)):
+            if status[i] == MAC_FAILED:
+                yield (str(ids[i]), data, MAC_FAILED_MSG)
+            elif status[i]:
+                yield (str(ids[i]), None, data)
+            else:
+                yield (str(ids[i]), data, '')
+    finally:
+        binMap.close()
@@ -3,55 +3,506 @@ __author__ = 'x37liu'
 import os
 import sys
 import csv
-from wrapper import Cipher
+import threading
+from Queue import Queue, Full
+from collections import deque, OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from CM import AES_3GPP, CMException
+import hexcodec
+from crypt_bat_bin import TASKS, SRB_TASKS, MAC_FAILED_MSG, \
+    BATCH_MAGIC, RESULTS_MAGIC, fileType, BatchWriter, \
+    ResultsWriter, readBatch as readBinBatch, readResults as readBinResults, \
+    countRows as countBinRows
 
-HEADER = ['ID','Task','Key','Count','Direction','Bearer','Data','Data','Source']
+HEADER = ['ID','Task','Key','Count','Direction','Bearer','Data','Data','Source','IP Key']
+
+# length in bits of the PDCP SN, when COUNT is given as HFN:SN
+SN_BITS = {'IP + SRB Cipher': 5, 'SRB Decipher + IP': 5}
+SN_BITS_DEFAULT = 12
+
+# number of rows sent at once to the cipher stage / a worker process
+CHUNK_ROWS = 256
+# number of rows sent at once when grouping rows by task and key
+GROUP_ROWS = 16384
+# number of items buffered between 2 stages of the pipeline
+QUEUE_DEPTH = 64
+# number of rows written between 2 flushes of the output file
+FLUSH_ROWS = 1024
+# number of data files read ahead, and max size of the data files kept
+# in memory, for the rows with data from file
+PREFETCH_DEPTH = 8
+PREFETCH_BUDGET = 64 << 20
+
+class BatchError(Exception):
+    pass
+
+# Batch pipeline:
+# readBatch (csv rows) -> decodeChunks (binary rows) -> processChunk (results)
+# -> writeBatch, each stage running in its own thread, connected to the next
+# one by a bounded queue of chunks of CHUNK_ROWS rows
+#
+# a binary row is (id, task, key, count, direct, bearer, data, error)
+# a result is (id, out, error)
+# SRB tasks rows have their key as (IP key, SRB key), the IP key coming from
+# the 9th csv column
+# an invalid row carries its error message down to the output file, in place
+# of its result
+#
+# a binary batch file (see crypt_bat_bin) holds binary rows already: it is
+# read straight into the cipher stage, and its results written in a binary
+# results file
+
+def readBatch(path):
+    # yield the rows of the batch csv file, without header
+    with open(path, 'rb') as csvfile:
+        reader = csv.reader(csvfile, delimiter = ',')
+        # skip header
+        next(reader, None)
+        for row in reader:
+            yield row
+
+def loadData(path):
+    # read a hex data file
+    if not os.path.exists(path):
+        raise BatchError('Invalid path')
+    # directories, unreadable files...
+    try:
+        dataFile = open(path, 'r')
+    except (IOError, OSError):
+        raise BatchError('Invalid path')
+    try:
+        return ''.join(hexcodec.decodeFile(dataFile))
+    except TypeError:
+        raise BatchError('Invalid data')
+    except (IOError, OSError):
+        raise BatchError('Invalid path')
+    finally:
+        dataFile.close()
+
+class Prefetcher:
+    '''
+    Read-ahead of the data files of batch rows, on a pool of depth threads
+    .request(path) schedules the reading of path
+    .get(path) -> data, for a path previously requested
+    Files already read are kept in memory (up to budget bytes) for other
+    rows referencing them
+    '''
+
+    def __init__(self, depth=PREFETCH_DEPTH, budget=PREFETCH_BUDGET):
+        self.depth = depth
+        self.budget = budget
+        self.pool = ThreadPool(depth)
+        # path -> [async result, number of rows waiting for it], in LRU order
+        self.files = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        # number of rows waiting for their data file
+        self.ahead = 0
+
+    def request(self, path):
+        entry = self.files.get(path)
+        if entry is None:
+            entry = self.files[path] = [self.pool.apply_async(loadData, (path,)), 0]
+        entry[1] += 1
+        self.ahead += 1
+
+    def get(self, path):
+        entry = self.files.pop(path)
+        self.files[path] = entry
+        entry[1] -= 1
+        self.ahead -= 1
+        data = None
+        try:
+            data = entry[0].get()
+        finally:
+            if path not in self.sizes:
+                self.sizes[path] = len(data) if data else 0
+                self.size += self.sizes[path]
+            self.evict()
+        return data
+
+    def full(self):
+        return self.ahead >= self.depth or self.size > self.budget
+
+    def evict(self):
+        # drop the least recently used files no row is waiting for
+        for path in list(self.files):
+            if self.size <= self.budget:
+                break
+            if self.files[path][1] == 0:
+                del self.files[path]
+                self.size -= self.sizes.pop(path, 0)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.files.clear()
+
+def loadRowData(row, prefetcher=None):
+    source = row[7]
+    if source == 'f':
+        if prefetcher is not None:
+            return prefetcher.get(row[6])
+        return loadData(row[6])
+    elif source == 's':
+        try:
+            return hexcodec.decode(row[6])
+        except TypeError:
+            raise BatchError('Invalid data')
+    raise BatchError('Invalid data source')
+
+def parseCount(field, task):
+    # COUNT in hex, or HFN:SN[:SN length in bits] with HFN and SN in hex
+    if ':' not in field:
+        return int(field, 16)
+    parts = field.split(':')
+    if len(parts) > 3:
+        raise ValueError(field)
+    bits = int(parts[2]) if len(parts) == 3 else SN_BITS.get(task, SN_BITS_DEFAULT)
+    hfn, sn = int(parts[0], 16), int(parts[1], 16)
+    if not 0 < bits < 32 or sn >> bits or hfn >> (32 - bits):
+        raise ValueError(field)
+    return (hfn << bits) | sn
+
+def decodeRow(row, prefetcher=None):
+    # convert a csv row into a binary row
+    id = row[0] if row else ''
+    if len(row) < 8:
+        return (id, None, None, None, None, None, None, 'Invalid row')
+    try:
+        data = loadRowData(row, prefetcher)
+    except BatchError as err:
+        return (id, None, None, None, None, None, None, str(err))
+    try:
+        key = hexcodec.decode(row[2])
+        if row[1] in SRB_TASKS:
+            key = (hexcodec.decode(row[8]), key)
+    except (TypeError, IndexError):
+        return (id, None, None, None, None, None, None, 'Invalid key')
+    try:
+        cnt = parseCount(row[3], row[1])
+        bearer = int(row[5])
+    except ValueError:
+        return (id, None, None, None, None, None, None, 'Invalid count or bearer')
+    if row[4] == 'uplink':
+        direct = 0
+    else:
+        direct = 1
+    return (id, row[1], key, cnt, direct, bearer, data, '')
+
+def decodeChunks(chunks, prefetcher=None):
+    if prefetcher is None:
+        for chunk in chunks:
+            yield [decodeRow(row) for row in chunk]
+        return
+    # request the data files of the rows ahead, decoding chunks only when
+    # enough files are being read (or the memory budget is reached), when
+    # QUEUE_DEPTH chunks are held or when no file is waited for
+    pending = deque()
+    for chunk in chunks:
+        for row in chunk:
+            if len(row) >= 8 and row[7] == 'f':
+                prefetcher.request(row[6])
+        pending.append(chunk)
+        while pending and (prefetcher.full() or prefetcher.ahead == 0 or
+                           len(pending) > QUEUE_DEPTH):
+            yield [decodeRow(row, prefetcher) for row in pending.popleft()]
+    while pending:
+        yield [decodeRow(row, prefetcher) for row in pending.popleft()]
+
+def processRow(cipher, row):
+    id, task, key, cnt, direct, bearer, data, err = row
+    if err:
+        return (id, None, err)
+    try:
+        if task == 'Integrity Check':
+            out = cipher.EIA2(key, cnt, bearer, direct, data)
+        elif task == 'IP + SRB Cipher':
+            out = cipher.SRB_protect(key[0], key[1], cnt, bearer, direct, data)
+        elif task == 'SRB Decipher + IP':
+            out, mac, check = cipher.SRB_unprotect(key[0], key[1], cnt, bearer, direct, data)
+            if not check:
+                return (id, out, MAC_FAILED_MSG)
+        elif task in TASKS:
+            out = cipher.EEA2(key, cnt, bearer, direct, data)
+        else:
+            return (id, None, 'Invalid task')
+    except CMException:
+        return (id, None, 'Invalid parameters')
+    return (id, out, '')
+
+_cipher = None
+
+def getCipher(cipher=None):
+    # cipher of the current (worker) process, if none is given
+    global _cipher
+    if cipher is None:
+        if _cipher is None:
+            _cipher = AES_3GPP()
+        cipher = _cipher
+    return cipher
+
+def processChunk(rows, cipher=None):
+    # process a chunk of binary rows, returns the list of results
+    cipher = getCipher(cipher)
+    return [processRow(cipher, row) for row in rows]
+
+def processGroup(cipher, task, key, counts, directs, bearers, datas):
+    # process the rows of a (task, key) group with batch calls,
+    # returns the list of (out, error)
+    num = len(datas)
+    if task == 'Integrity Check':
+        out = cipher.EIA2_batch(key, counts, bearers, directs, datas)
+        return [(out[4*j:4*j+4], '') for j in range(num)]
+    if task == 'IP + SRB Cipher':
+        if min(map(len, datas)) < 1:
+            raise CMException()
+        macs = cipher.EIA2_batch(key[0], counts, bearers, directs, datas)
+        out, offsets = cipher.EEA2_batch(key[1], counts, bearers, directs,
+                                         [datas[j][1:] + macs[4*j:4*j+4] for j in range(num)])
+        return [(datas[j][:1] + out[offsets[j]:offsets[j+1]], '') for j in range(num)]
+    if task == 'SRB Decipher + IP':
+        if min(map(len, datas)) < 5:
+            raise CMException()
+        out, offsets = cipher.EEA2_batch(key[1], counts, bearers, directs,
+                                         [data[1:] for data in datas])
+        pdus = [datas[j][:1] + out[offsets[j]:offsets[j+1]-4] for j in range(num)]
+        macs = ''.join([out[offsets[j+1]-4:offsets[j+1]] for j in range(num)])
+        check = cipher.EIA2_batch(key[0], counts, bearers, directs, pdus, None, macs)[1]
+        return [(pdus[j], '' if check[j>>3] & (0x80 >> (j&7)) else MAC_FAILED_MSG)
+                for j in range(num)]
+    out, offsets = cipher.EEA2_batch(key, counts, bearers, directs, datas)
+    return [(out[offsets[j]:offsets[j+1]], '') for j in range(num)]
+
+def processGroupedChunk(rows, cipher=None):
+    # process a chunk of binary rows grouped by (task, key), with one batch
+    # call per group, returns the list of results in the order of rows
+    cipher = getCipher(cipher)
+    results = [None]*len(rows)
+    groups = {}
+    for i, row in enumerate(rows):
+        if row[7] or row[1] not in TASKS:
+            results[i] = processRow(cipher, row)
+        else:
+            groups.setdefault((row[1], row[2]), []).append(i)
+    for (task, key), idx in groups.items():
+        counts = [rows[i][3] for i in idx]
+        directs = [rows[i][4] for i in idx]
+        bearers = [rows[i][5] for i in idx]
+        datas = [rows[i][6] for i in idx]
+        try:
+            outs = processGroup(cipher, task, key, counts, directs, bearers, datas)
+        except CMException:
+            # get the error of each row
+            for i in idx:
+                results[i] = processRow(cipher, rows[i])
+            continue
+        for j, i in enumerate(idx):
+            results[i] = (rows[i][0],) + outs[j]
+    return results
+
+def writeBatch(path, chunks):
+    # write chunks of results into the output csv file,
+    # returns the number of errors
+    errors = 0
+    unflushed = 0
+    with open(path, 'wb') as outFile:
+        writer = csv.writer(outFile)
+        for chunk in chunks:
+            for id, out, err in chunk:
+                if err:
+                    writer.writerow((id, hexcodec.encode(out) if out is not None else '', err))
+                    errors += 1
+                else:
+                    writer.writerow((id, hexcodec.encode(out)))
+            unflushed += len(chunk)
+            if unflushed >= FLUSH_ROWS:
+                outFile.flush()
+                unflushed = 0
+    return errors
+
+def writeBinBatch(path, chunks):
+    # write chunks of results into the output binary results file,
+    # returns the number of errors
+    errors = 0
+    unflushed = 0
+    writer = ResultsWriter(path)
+    try:
+        for chunk in chunks:
+            for id, out, err in chunk:
+                writer.add(id, out, err)
+                if err:
+                    errors += 1
+            unflushed += len(chunk)
+            if unflushed >= FLUSH_ROWS:
+                writer.flush()
+                unflushed = 0
+    finally:
+        writer.close()
+    return errors
+
+def convertBatch(input, output):
+    # convert a batch csv file into a binary batch file, or a binary results
+    # file into a results csv file
+    if fileType(input) == RESULTS_MAGIC:
+        writeBatch(output, chunkRows(readBinResults(input)))
+        return
+    writer = BatchWriter(output)
+    try:
+        for row in readBatch(input):
+            # blank lines
+            if not row:
+                continue
+            row = decodeRow(row)
+            try:
+                writer.add(*row)
+            except (ValueError, OverflowError):
+                raise BatchError('Invalid ID %s' % row[0])
+    finally:
+        writer.close()
+
+def countRows(path):
+    # number of rows of a batch file, lines after the header for a csv file
+    if fileType(path) == BATCH_MAGIC:
+        return countBinRows(path)
+    lines = 0
+    with open(path, 'rb') as csvfile:
+        for buf in iter(lambda: csvfile.read(1 << 20), ''):
+            lines += buf.count('\n')
+    return max(lines - 1, 0)
+
+def track(chunks, total, progress=None, cancel=None):
+    # yield chunks of results, reporting the number of rows done (out of
+    # total) to progress, and stopping once the cancel event is set
+    done = 0
+    for chunk in chunks:
+        if cancel is not None and cancel.is_set():
+            raise BatchError('Cancelled')
+        yield chunk
+        done += len(chunk)
+        if progress is not None:
+            progress(done, total)
+
+def chunkRows(rows, size=CHUNK_ROWS):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def pipe(items, depth=QUEUE_DEPTH):
+    # run the items iterator in its own thread, and yield its items
+    # through a bounded queue
+    queue = Queue(depth)
+    stop = threading.Event()
+    end = object()
+    def run():
+        try:
+            for item in items:
+                while not stop.is_set():
+                    try:
+                        queue.put((item, None), timeout=0.1)
+                        break
+                    except Full:
+                        pass
+                if stop.is_set():
+                    return
+            queue.put((end, None))
+        except Exception as err:
+            queue.put((end, err))
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, err = queue.get()
+            if item is end:
+                if err is not None:
+                    raise err
+                return
+            yield item
+    finally:
+        stop.set()
+
+def orderedMap(pool, func, chunks, depth):
+    # apply func to chunks in pool, with at most depth chunks in flight,
+    # and yield results in the order of chunks
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(func, (chunk,)))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
 class AES_Batch:
     def __init__(self):
-        self.cipher = Cipher()
+        self.cipher = AES_3GPP()
 
-    def parseBatch(self, input, output):
-        outFile = open(output, 'wb')
-        writer = csv.writer(outFile)
+    def parseBatch(self, input, output, workers=1, prefetch=PREFETCH_DEPTH,
+                   budget=PREFETCH_BUDGET, grouped=False, progress=None, cancel=None):
+        # progress(rows done, total rows) is called from the calling thread
+        # after each chunk of rows written, setting the cancel event stops
+        # the batch
         if not os.path.exists(input) or input == output:
-            outFile.close()
-            os.remove(output)
             return 'Invalid input path! \n'
-        with open(input, 'rb') as csvfile:
-            reader = csv.reader(csvfile, delimiter = ',')
-            isHead = True
-            for row in reader:
-                if isHead:
-                    isHead = False
-                    continue
-                id = row[0]
-                task = row[1]
-                key = row[2]
-                cnt = int(row[3], 16)
-                direct = row[4]
-                bearer = int(row[5])
-                source = row[7]
-
-                if source == 'f':
-                    if not os.path.exists(row[6]):
-                        return 'Invalid path at task ' + id + '\n'
-                    dataFile = open(row[6], 'r')
-                    data = dataFile.read()
-                    dataFile.close()
-                elif source == 's':
-                    data = row[6]
-                else:
-                    return 'Invalid data source ' + id + '\n'
-
-                if task == 'Integrity Check':
-                    out = self.cipher.IP(key, cnt, direct, bearer, data)
-                elif task == 'Cipher':
-                    out = self.cipher.encrypt(key, cnt, direct, bearer, data)
-                elif task == 'Decipher':
-                    out = self.cipher.decrypt(key, cnt, direct, bearer, data)
-                else:
-                    return 'Invalid task ' + id + '\n'
-                writer.writerow((id, out))
-        outFile.close()
+        pool = None
+        binary = fileType(input) == BATCH_MAGIC
+        prefetcher = None
+        if binary:
+            # no csv parsing or hex decoding: binary rows go straight to
+            # the cipher stage
+            readRows = readBinBatch
+            write = writeBinBatch
+        else:
+            readRows = readBatch
+            write = writeBatch
+            if prefetch > 0:
+                prefetcher = Prefetcher(prefetch, budget)
+        if grouped:
+            # large chunks, each one processed group of rows by group of rows
+            # sharing the same task and key
+            process = processGroupedChunk
+            chunks = pipe(chunkRows(readRows(input), GROUP_ROWS), 2)
+        else:
+            process = processChunk
+            chunks = pipe(chunkRows(readRows(input)))
+        if not binary:
+            chunks = pipe(decodeChunks(chunks, prefetcher))
+        if workers > 1:
+            # rows are independent: process chunks of rows in parallel,
+            # results coming back in the order of the batch
+            pool = Pool(workers)
+            results = orderedMap(pool, process, chunks, 2*workers)
+        else:
+            results = (process(chunk, self.cipher) for chunk in chunks)
+        results = pipe(results)
+        if progress is not None or cancel is not None:
+            results = track(results, countRows(input) if progress else 0,
+                            progress, cancel)
+        try:
+            errors = write(output, results)
+        except BatchError as err:
+            return '%s! \n' % err
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if prefetcher is not None:
+                prefetcher.close()
+        if errors:
+            return '%d invalid rows, see errors in output file \n' % errors
+        return ''
+
+    def convert(self, input, output):
+        if not os.path.exists(input) or input == output:
+            return 'Invalid input path! \n'
+        try:
+            convertBatch(input, output)
+        except BatchError as err:
+            return '%s! \n' % err
         return ''
@@ -0,0 +1,231 @@
+__author__ = 'x37liu'
+
+import os
+import sys
+import json
+import socket
+import struct
+import argparse
+import threading
+import SocketServer
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+from CM import CMException
+from wrapper import Cipher
+
+# Crypto service: each request / response is a frame made of its length
+# (uint32, big-endian) followed by a JSON object
+# request:  {"id": any, "task": "ip"|"ci"|"de"|"ipci"|"deip", "key": hex,
+#            "count": hex string or integer, "direction": "uplink"|"downlink"|0|1,
+#            "bearer": integer, "data": hex, "ip_key": hex (ipci / deip only)}
+# response: {"id": id, "out": hex} or {"id": id, "error": message},
+#           plus "mac": hex and "check": bool for deip
+# requests of a connection are pipelined, responses coming back in the order
+# of the requests
+
+LENGTH = struct.Struct('!I')
+# max size of a frame
+FRAME_MAX = 64 << 20
+# number of requests of a connection in flight
+INFLIGHT_MAX = 64
+# size of the data (in hex characters) from which requests are processed by
+# the executor rather than by the connection thread
+BULK_SIZE = 1 << 16
+# number of threads of the executor
+WORKERS = 4
+
+def handleRequest(cipher, req):
+    # process the request dict req with cipher (a wrapper.Cipher),
+    # returns the response dict
+    resp = {'id': req.get('id') if isinstance(req, dict) else None}
+    try:
+        task = req['task']
+        count = req['count']
+        if isinstance(count, basestring):
+            count = int(count, 16)
+        args = (req['key'], count, req.get('direction', 'uplink'), int(req['bearer']),
+                req['data'])
+        if task == 'ip':
+            resp['out'] = cipher.IP(*args)
+        elif task == 'ci':
+            resp['out'] = cipher.encrypt(*args)
+        elif task == 'de':
+            resp['out'] = cipher.decrypt(*args)
+        elif task == 'ipci':
+            resp['out'] = cipher.SRB_protect(req['ip_key'], *args)
+        elif task == 'deip':
+            resp['out'], resp['mac'], resp['check'] = cipher.SRB_unprotect(req['ip_key'], *args)
+        else:
+            resp['error'] = 'Invalid task'
+    except (KeyError, TypeError, ValueError, AttributeError, CMException):
+        resp.pop('out', None)
+        resp['error'] = 'Invalid request'
+    return resp
+
+def readFrame(src):
+    # read a frame from the file object src, None at the end of the stream
+    head = src.read(LENGTH.size)
+    if len(head) < LENGTH.size:
+        return None
+    length = LENGTH.unpack(head)[0]
+    if length > FRAME_MAX:
+        raise ValueError('Frame too long')
+    body = src.read(length)
+    if len(body) < length:
+        return None
+    return body
+
+def writeFrame(dst, body):
+    dst.write(LENGTH.pack(len(body)) + body)
+
+class Done:
+    # response of a request processed by the connection thread, with the
+    # same get() as the executor ones
+    def __init__(self, resp):
+        self.resp = resp
+
+    def get(self):
+        return self.resp
+
+class CryptoHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        # this thread reads and processes (or hands over) requests, while a
+        # writer thread sends responses in order
+        pending = Queue(INFLIGHT_MAX)
+        writer = threading.Thread(target=self.writeResponses, args=(pending,))
+        writer.daemon = True
+        writer.start()
+        try:
+            while True:
+                body = readFrame(self.rfile)
+                if body is None:
+                    break
+                try:
+                    req = json.loads(body)
+                except ValueError:
+                    pending.put(Done({'id': None, 'error': 'Invalid request'}))
+                    continue
+                data = req.get('data') if isinstance(req, dict) else None
+                if isinstance(data, basestring) and len(data) >= BULK_SIZE:
+                    pending.put(self.server.executor.apply_async(
+                        handleRequest, (self.server.cipher, req)))
+                else:
+                    pending.put(Done(handleRequest(self.server.cipher, req)))
+        finally:
+            pending.put(None)
+            writer.join()
+
+    def writeResponses(self, pending):
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            try:
+                writeFrame(self.wfile, json.dumps(item.get()))
+                if pending.empty():
+                    self.wfile.flush()
+            except socket.error:
+                # the client is gone, drain the remaining requests
+                pass
+        try:
+            self.wfile.flush()
+        except socket.error:
+            pass
+
+class CryptoServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, workers=WORKERS):
+        SocketServer.TCPServer.__init__(self, address, CryptoHandler)
+        self.cipher = Cipher()
+        self.executor = ThreadPool(workers)
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        self.executor.close()
+        self.executor.join()
+
+class CryptoUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, workers=WORKERS):
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, CryptoHandler)
+        self.cipher = Cipher()
+        self.executor = ThreadPool(workers)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        self.executor.close()
+        self.executor.join()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+class Client:
+    '''
+    Client of the crypto service
+    .send(req) sends a request without waiting for its response
+    .recv() -> response, of the oldest request sent
+    .call(req) -> response
+    Responses must be read while sending: keep no more than a few hundred
+    requests in flight, or both ends end up blocked on full socket buffers
+    '''
+
+    def __init__(self, address):
+        if isinstance(address, basestring):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.connect(address)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+
+    def send(self, req, flush=True):
+        writeFrame(self.wfile, json.dumps(req))
+        if flush:
+            self.wfile.flush()
+
+    def recv(self):
+        self.wfile.flush()
+        body = readFrame(self.rfile)
+        if body is None:
+            raise socket.error('Connection closed')
+        return json.loads(body)
+
+    def call(self, req):
+        self.send(req)
+        return self.recv()
+
+    def close(self):
+        self.wfile.close()
+        self.rfile.close()
+        self.sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description = 'AES IP/Cipher/Decipher service.')
+    parser.add_argument('--unix', type = str, help = 'Unix socket path')
+    parser.add_argument('--host', type = str, default = '127.0.0.1',
+                        help = 'TCP host (default 127.0.0.1)')
+    parser.add_argument('--port', type = int, default = 7878, help = 'TCP port')
+    parser.add_argument('--workers', type = int, default = WORKERS,
+                        help = 'number of threads for bulk requests')
+    args = parser.parse_args()
+    if args.unix:
+        server = CryptoUnixServer(args.unix, args.workers)
+    else:
+        server = CryptoServer((args.host, args.port), args.workers)
+    sys.stdout.write('Serving on %s\n' % (server.server_address,))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+__author__ = 'x37liu'
+
+from binascii import hexlify, unhexlify
+try:
+    from Crypto.Util.strxor import strxor
+except ImportError:
+    strxor = None
+
+# Hex text codec of the text-facing paths (command line, GUI, batch files):
+# whitespace and line breaks are ignored, and a 0x (or 0X) prefix is
+# removed at the start of each whitespace-separated token only, so that
+# '0x0123 0x4567' is decoded but '01230x4567' is invalid
+#
+# decoding errors raise TypeError, as str.decode('hex') does
+
+# size of the chunks read from files, in hex characters
+BUF_SIZE = 1 << 20
+
+WHITESPACE = ' \t\r\n\v\f'
+PREFIXES = ('0x', '0X')
+
+# big hex strings are decoded with translation tables (hex digit -> nibble,
+# low nibble -> high nibble) and a XOR of the high and low nibbles, all made
+# natively, being 2 to 3 times faster than unhexlify from TABLE_MIN digits
+TABLE_MIN = 1 << 15
+INVALID = '\xff'
+NIBBLES = [INVALID]*256
+for i, c in enumerate('0123456789abcdef'):
+    NIBBLES[ord(c)] = NIBBLES[ord(c.upper())] = chr(i)
+NIBBLES = ''.join(NIBBLES)
+HIGH = ''.join([chr((i << 4) & 0xff) for i in range(256)])
+
+def ascii(text):
+    # str from the (unicode) text given by the GUI
+    if isinstance(text, unicode):
+        try:
+            return text.encode('ascii')
+        except UnicodeError:
+            raise TypeError('Non-hexadecimal digit found')
+    return text
+
+def strip(text, start=True):
+    # hex digits of text, start telling whether text begins a token (and
+    # not the end of a token of the previous chunk)
+    if 'x' not in text and 'X' not in text:
+        return text.translate(None, WHITESPACE)
+    tokens = text.split()
+    first = 0 if start or text[:1] in WHITESPACE else 1
+    return ''.join(tokens[:first] + [token[2:] if token[:2] in PREFIXES else token
+                                     for token in tokens[first:]])
+
+def unhex(text, delete=''):
+    # binary string of the hex digits of text, delete characters being
+    # removed in the same pass
+    if strxor is None or len(text) < TABLE_MIN:
+        if delete:
+            text = text.translate(None, delete)
+        return unhexlify(text)
+    nibbles = text.translate(NIBBLES, delete)
+    if len(nibbles) % 2:
+        raise TypeError('Odd-length string')
+    if INVALID in nibbles:
+        raise TypeError('Non-hexadecimal digit found')
+    # strxor not taking empty strings (whitespace only text)
+    if not nibbles:
+        return ''
+    return strxor(nibbles[0::2].translate(HIGH), nibbles[1::2])
+
+def decode(text):
+    # binary string of the hex text
+    text = ascii(text)
+    if 'x' in text or 'X' in text:
+        return unhex(strip(text))
+    return unhex(text, WHITESPACE)
+
+def encode(data):
+    # hex string of the binary string, bytearray or buffer data
+    return hexlify(data)
+
+class Decoder:
+    # decode hex text given chunk after chunk, chunks being cut anywhere
+    # (even inside a prefix)
+    # .update(text) -> data
+    # .finalize() -> data (raises TypeError if an odd digit is left)
+    def __init__(self):
+        # text held back, that may be the beginning of a prefix
+        self.carry = ''
+        # whether carry begins a token
+        self.start = True
+        # odd hex digit left for the next chunk
+        self.odd = ''
+
+    def update(self, text):
+        text = self.carry + ascii(text)
+        if not text:
+            return ''
+        start = self.start
+        # hold back a token beginning of less than 2 characters
+        if text[-1] in WHITESPACE:
+            self.carry, self.start = '', True
+        elif (len(text) > 1 and text[-2] in WHITESPACE) or (len(text) == 1 and start):
+            self.carry, self.start = text[-1], True
+            text = text[:-1]
+        else:
+            self.carry, self.start = '', False
+        digits = self.odd + strip(text, start)
+        if len(digits) % 2:
+            self.odd = digits[-1]
+            digits = digits[:-1]
+        else:
+            self.odd = ''
+        return unhex(digits)
+
+    def finalize(self):
+        digits = self.odd + strip(self.carry, self.start)
+        self.carry, self.start, self.odd = '', True, ''
+        if len(digits) % 2:
+            raise TypeError('Odd-length string')
+        return unhex(digits)
+
+def decodeChunks(chunks):
+    # yield binary chunks decoded from the hex text chunks iterable
+    decoder = Decoder()
+    for text in chunks:
+        data = decoder.update(text)
+        if data:
+            yield data
+    data = decoder.finalize()
+    if data:
+        yield data
+
+def decodeFile(src, bufsize=BUF_SIZE):
+    # yield binary chunks decoded from the hex file object src
+    return decodeChunks(iter(lambda: src.read(bufsize), ''))
+
+def encodeChunks(chunks):
+    # yield hex chunks encoded from the binary chunks iterable
+    for data in chunks:
+        yield hexlify(data)
@@ -0,0 +1,122 @@
+__author__ = 'x37liu'
+
+import threading
+from functools import wraps
+from timeit import default_timer as timer
+
+# Opt-in instrumentation of the crypto stack: enable() replaces the probed
+# functions and methods (see probes) with wrappers counting calls, bytes and
+# time per stage, disable() puts the originals back, so that nothing is
+# added to the calls while disabled
+#
+# stages are nested (Cipher.encrypt includes hex decode, EEA2 and AES-CTR),
+# and counts made in batch worker processes (workers > 1) are not collected
+
+enabled = False
+# stage -> [calls, bytes, seconds]
+_counters = {}
+_lock = threading.Lock()
+# (owner, name) -> original function, while enabled
+_originals = {}
+
+def hexBytes(data):
+    # bytes of a hex string, with or without 0x prefix
+    return (len(data) - 2*data.startswith('0x'))//2
+
+def probes():
+    # (owner, name, stage, size) of the instrumented functions, owner being
+    # a module or a class, and size(args, result) the number of bytes
+    # processed by a call
+    import CM
+    import wrapper
+    import hexcodec
+    import crypt_bat_bk
+    Cipher = wrapper.Cipher
+    AES_3GPP = CM.AES_3GPP
+    return [
+        (wrapper, 'fromHex', 'hex decode', lambda a, r: len(r)),
+        (wrapper, 'toHex', 'hex encode', lambda a, r: len(a[0])),
+        (hexcodec, 'decode', 'hex decode', lambda a, r: len(r)),
+        (hexcodec, 'encode', 'hex encode', lambda a, r: len(a[0])),
+        (hexcodec.Decoder, 'update', 'hex decode', lambda a, r: len(r)),
+        (Cipher, 'IP', 'Cipher.IP', lambda a, r: hexBytes(a[5])),
+        (Cipher, 'encrypt', 'Cipher.encrypt', lambda a, r: hexBytes(a[5])),
+        (Cipher, 'decrypt', 'Cipher.decrypt', lambda a, r: hexBytes(a[5])),
+        (Cipher, 'IP_bytes', 'Cipher.IP_bytes', lambda a, r: len(a[5])),
+        (Cipher, 'encrypt_bytes', 'Cipher.encrypt_bytes', lambda a, r: len(a[5])),
+        (Cipher, 'IP_batch', 'Cipher.IP_batch', lambda a, r: sum(map(hexBytes, a[5]))),
+        (Cipher, 'encrypt_batch', 'Cipher.encrypt_batch', lambda a, r: sum(map(hexBytes, a[5]))),
+        (Cipher, 'SRB_protect', 'Cipher.SRB_protect', lambda a, r: hexBytes(a[6])),
+        (Cipher, 'SRB_unprotect', 'Cipher.SRB_unprotect', lambda a, r: hexBytes(a[6])),
+        (AES_3GPP, 'EEA2', 'EEA2', lambda a, r: len(r)),
+        (AES_3GPP, 'EIA2', 'EIA2', lambda a, r: len(a[5]) if len(a) > 5 else 0),
+        (AES_3GPP, 'AES_CMAC', 'AES_CMAC', lambda a, r: len(a[2]) if len(a) > 2 else 0),
+        (AES_3GPP, '_AES_3GPP__cmac', 'CMAC', lambda a, r: len(a[5])),
+        (AES_3GPP, 'EEA2_batch', 'EEA2_batch', lambda a, r: len(r[0])),
+        (AES_3GPP, 'EIA2_batch', 'EIA2_batch', lambda a, r: sum(map(len, a[5]))),
+        (AES_3GPP, 'SRB_protect', 'SRB_protect', lambda a, r: len(r)),
+        (AES_3GPP, 'SRB_unprotect', 'SRB_unprotect', lambda a, r: len(r[0])),
+        (CM, 'aes_ctr', 'AES-CTR', lambda a, r: len(r)),
+        (CM, 'ctr_blocks', 'CTR blocks', lambda a, r: len(r)),
+        (CM, 'cmac_key_sched', 'CMAC key schedule', None),
+        (CM.KeystreamCache, 'get', 'keystream cache', lambda a, r: len(r or '')),
+        (crypt_bat_bk, 'loadData', 'batch load data file', lambda a, r: len(r)),
+        (crypt_bat_bk, 'decodeRow', 'batch decode row', lambda a, r: len(r[6] or '')),
+        (crypt_bat_bk, 'processChunk', 'batch process chunk',
+         lambda a, r: sum([len(row[6] or '') for row in a[0]])),
+        (crypt_bat_bk, 'processGroupedChunk', 'batch process chunk',
+         lambda a, r: sum([len(row[6] or '') for row in a[0]])),
+        ]
+
+def probe(func, stage, size):
+    counter = _counters.setdefault(stage, [0, 0, 0.0])
+    def probed(*args, **kwargs):
+        t0 = timer()
+        result = func(*args, **kwargs)
+        t1 = timer()
+        n = size(args, result) if size is not None else 0
+        with _lock:
+            counter[0] += 1
+            counter[1] += n
+            counter[2] += t1 - t0
+        return result
+    # same name and module, for the chunk functions pickled to the workers
+    return wraps(func)(probed)
+
+def enable():
+    global enabled
+    if enabled:
+        return
+    for owner, name, stage, size in probes():
+        func = owner.__dict__[name]
+        _originals[(owner, name)] = func
+        setattr(owner, name, probe(func, stage, size))
+    enabled = True
+
+def disable():
+    global enabled
+    for (owner, name), func in _originals.items():
+        setattr(owner, name, func)
+    _originals.clear()
+    enabled = False
+
+def reset():
+    with _lock:
+        for counter in _counters.values():
+            counter[:] = [0, 0, 0.0]
+
+def snapshot():
+    # stage -> {'calls', 'bytes', 'seconds'}, for the stages called
+    with _lock:
+        return dict([(stage, {'calls': calls, 'bytes': size, 'seconds': sec})
+                     for stage, (calls, size, sec) in _counters.items() if calls])
+
+def report(dst):
+    # write the counters as a table, slowest stages first
+    stats = snapshot()
+    dst.write('%-22s %10s %14s %10s %10s\n' % ('stage', 'calls', 'bytes', 'ms', 'MB/s'))
+    for stage in sorted(stats, key=lambda stage: -stats[stage]['seconds']):
+        s = stats[stage]
+        rate = s['bytes']/s['seconds']/(1 << 20) if s['seconds'] else 0
+        dst.write('%-22s %10d %14d %10.1f %10.1f\n'
+                  % (stage, s['calls'], s['bytes'], s['seconds']*1000, rate))
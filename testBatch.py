@@ -0,0 +1,146 @@
+__author__ = 'x37liu'
+import os
+import tempfile
+import threading
+from crypt_bat_bk import AES_Batch, Prefetcher, decodeChunks
+
+def test():
+    # batch files reference data files relative to their own directory
+    cwd = os.getcwd()
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dist', 'test'))
+    batch = AES_Batch()
+    outPath = tempfile.mktemp()
+
+    msg = batch.parseBatch('batchList.csv', outPath)
+    output = open(outPath, 'rb').read().splitlines()
+    print "A: " + str(msg == '' and output == ['1,aa795e00',
+                                              '2,ad1d7e855d13fbd6',
+                                              '3,10101010c76c5132',
+                                              '4,ee1cae4f34904f46515bc173562021c64afe08fc',
+                                              '5,45e0003c4cce00003d014091ac144077ac1456e2'])
+
+    msg = batch.parseBatch('batchList.csv', outPath, prefetch = 1, budget = 0)
+    # errors of the prefetched files other than BatchError raised as such
+    prefetcher = Prefetcher(1)
+    prefetcher.request('c3\0')
+    try:
+        prefetcher.get('c3\0')
+        error = None
+    except Exception as err:
+        error = err
+    prefetcher.close()
+    print "B: " + str(msg == '' and open(outPath, 'rb').read().splitlines() == output and
+                      type(error) is TypeError)
+
+    msg = batch.parseBatch('batchList.csv', outPath, grouped = True)
+    grouped = open(outPath, 'rb').read().splitlines()
+    # rows with empty data, alone in their group or not
+    emptyPath = tempfile.mktemp()
+    emptyFile = open(emptyPath, 'wb')
+    emptyFile.write('ID,Task,Key,Count,Direction,Bearer,Data,Data Source\r\n'
+                    '1,Cipher,941c08ca34df130ee7644ef803b90eda,0x00,uplink,0,,s\r\n'
+                    '2,Decipher,941c08ca34df130ee7644ef803b90eda,0x00,uplink,0,,s\r\n'
+                    '3,Decipher,941c08ca34df130ee7644ef803b90eda,0x00,uplink,0,c3,f\r\n')
+    emptyFile.close()
+    msg = msg + batch.parseBatch(emptyPath, outPath, grouped = True)
+    empty = open(outPath, 'rb').read().splitlines()
+    msg = msg + batch.parseBatch(emptyPath, outPath, workers = 2, grouped = True)
+    os.remove(emptyPath)
+    print "C: " + str(msg == '' and grouped == output and
+                      empty == ['1,', '2,', '3,10101010c76c5132'] and
+                      open(outPath, 'rb').read().splitlines() == empty)
+
+    inPath = tempfile.mktemp()
+    inFile = open(inPath, 'wb')
+    inFile.write('ID,Task,Key,Count,Direction,Bearer,Data,Data Source\r\n'
+                 '1,Cipher,941c08ca34df130ee7644ef803b90eda,0x00,uplink,0,c3,x\r\n'
+                 '2,Decipher,941c08ca34df130ee7644ef803b90eda,0x00,uplink,0,c3,f\r\n'
+                 '3,Decipher,941c08ca34df130ee7644ef803b90eda,0x00,uplink,0,.,f\r\n')
+    inFile.close()
+    msg = batch.parseBatch(inPath, outPath, prefetch = 0)
+    output = open(outPath, 'rb').read().splitlines()
+    msg = msg + batch.parseBatch(inPath, outPath, workers = 2)
+    print "D: " + str(msg != '' and output == open(outPath, 'rb').read().splitlines() and
+                      output == ['1,,Invalid data source',
+                                 '2,10101010c76c5132',
+                                 '3,,Invalid path'])
+
+    binPath = tempfile.mktemp()
+    msg = batch.convert(inPath, binPath)
+    msg = msg + batch.parseBatch(binPath, outPath, workers = 2)
+    msg = msg + batch.convert(outPath, inPath)
+    converted = open(inPath, 'rb').read().splitlines()
+    # blank lines skipped, IDs out of the 32 bits range refused
+    inFile = open(inPath, 'wb')
+    inFile.write('ID,Task,Key,Count,Direction,Bearer,Data,Data Source\r\n'
+                 '\r\n'
+                 '1,Decipher,941c08ca34df130ee7644ef803b90eda,0x00,uplink,0,c3,f\r\n')
+    inFile.close()
+    blank = (batch.convert(inPath, binPath) + batch.parseBatch(binPath, outPath) +
+             batch.convert(outPath, inPath))
+    blank = blank == '' and open(inPath, 'rb').read().splitlines() == ['1,10101010c76c5132']
+    ids = []
+    for id in ('4294967296', '-1'):
+        inFile = open(inPath, 'wb')
+        inFile.write('ID,Task,Key,Count,Direction,Bearer,Data,Data Source\r\n'
+                     '%s,Cipher,941c08ca34df130ee7644ef803b90eda,0x00,uplink,0,c3,f\r\n' % id)
+        inFile.close()
+        ids.append(batch.convert(inPath, binPath))
+    print "E: " + str(msg != '' and converted == output and blank and
+                      ids == ['Invalid ID 4294967296! \n', 'Invalid ID -1! \n'])
+
+    done = []
+    msg = batch.parseBatch('batchList.csv', outPath,
+                           progress = lambda rows, total: done.append((rows, total)))
+    cancel = threading.Event()
+    cancel.set()
+    msg = msg + batch.parseBatch('batchList.csv', outPath, cancel = cancel)
+    print "F: " + str(msg == 'Cancelled! \n' and done == [(5, 5)])
+
+    inFile = open(inPath, 'wb')
+    inFile.write('ID,Task,Key,Count,Direction,Bearer,Data,Data Source,IP Key\r\n'
+                 '1,IP + SRB Cipher,941c08ca34df130ee7644ef803b90eda,0:1F,uplink,3,03aabbccdd,s,'
+                 '5ead1f52e92ced3add9486d1b066c693\r\n'
+                 '2,SRB Decipher + IP,941c08ca34df130ee7644ef803b90eda,0x1F,uplink,3,0374f48c6e579c2702,s,'
+                 '5ead1f52e92ced3add9486d1b066c693\r\n'
+                 '3,SRB Decipher + IP,941c08ca34df130ee7644ef803b90eda,0x20,uplink,3,0374f48c6e579c2702,s,'
+                 '5ead1f52e92ced3add9486d1b066c693\r\n'
+                 '4,DRB Cipher,a24fd61d0b627b91f7451be11df4d40e,0:1C3,downlink,0,'
+                 '45e0003c4cce00003d014091ac144077ac1456e2,s\r\n'
+                 '5,DRB Decipher,a24fd61d0b627b91f7451be11df4d40e,3:43:7,downlink,0,ee1cae4f,s\r\n')
+    inFile.close()
+    expected = ['1,0374f48c6e579c2702',
+                '2,03aabbccdd',
+                '3,03d2c947c5,Integrity check failed',
+                '4,ee1cae4f34904f46515bc173562021c64afe08fc',
+                '5,45e0003c']
+    msg = batch.parseBatch(inPath, outPath)
+    output = open(outPath, 'rb').read().splitlines()
+    msg = msg + batch.parseBatch(inPath, outPath, grouped = True)
+    print "G: " + str(msg != '' and output == expected and
+                      open(outPath, 'rb').read().splitlines() == expected)
+
+    # inline rows decoded before the whole input is read, files prefetched or not
+    read = []
+    def chunks(rows):
+        for i in range(4):
+            read.append(i)
+            yield [rows[i % len(rows)]]
+    prefetcher = Prefetcher(2)
+    decoded = []
+    for rows in ([['1', 'Cipher', '941c08ca34df130ee7644ef803b90eda', '0x00', 'uplink', '0', 'aa', 's']],
+                 [['1', 'Cipher', '941c08ca34df130ee7644ef803b90eda', '0x00', 'uplink', '0', 'aa', 's'],
+                  ['2', 'Cipher', '941c08ca34df130ee7644ef803b90eda', '0x00', 'uplink', '0', 'c3', 'f']]):
+        del read[:]
+        for chunk in decodeChunks(chunks(rows), prefetcher):
+            decoded.append(len(read))
+    prefetcher.close()
+    print "H: " + str(decoded == [1, 2, 3, 4, 1, 4, 4, 4])
+
+    os.remove(binPath)
+    os.remove(inPath)
+    os.remove(outPath)
+    os.chdir(cwd)
+
+if __name__ == '__main__':
+    test()
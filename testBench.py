@@ -0,0 +1,20 @@
+__author__ = 'x37liu'
+import os
+import json
+import tempfile
+import bench
+
+def test():
+    # smoke run of all the benchmarks up to the 16MB cap of the one-shot calls and
+    # beyond, the payloads above it being streamed
+    outPath = tempfile.mktemp('.json')
+    bench.main(['--max-size', str(16 << 20), '--min-time', '0', '--batch-rows', '30',                '--output', outPath])
+    results = json.load(open(outPath))['results']
+    os.remove(outPath)
+    big = sorted([result['bench'] for result in results if result['size'] == 16 << 20])
+    print "A: " + str(big == ['AES_CMAC', 'EEA2 stream', 'EIA2 stream'] and
+                      len([result for result in results if result['bench'] == 'Cipher.encrypt'])
+                      == len(bench.SIZES) - 2)
+
+if __name__ == '__main__':
+    test()
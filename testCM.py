@@ -33,7 +33,7 @@ with this program; if not, write to the Free Software Foundation, Inc.,
 # - AES (EEA2, EIA2) - from pycrypto
 #######################################################
 
-from time import time
+from struct import pack
 from CM import AES_3GPP
 import binascii
 ###
@@ -254,6 +254,186 @@ def aes_EIA2_testset_12():
     output  = '45e0003c4cce00003d014091ac144077ac1456e2'
     return aes3gpp.EEA2(key, count, bearer, direct, data, bitlen).encode('hex') == output
 
+###
+# AES-CMAC: testsets from NIST SP 800-38B
+###
+
+def aes_CMAC_testset():
+    aes3gpp = AES_3GPP()
+    key     = '2b7e151628aed2a6abf7158809cf4f3c'.decode('hex')
+    data    = ('6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51'
+               '30c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710'
+              ).decode('hex')
+    outputs = [(0,  'bb1d6929e95937287fa37d129b756746'.decode('hex')),
+               (16, '070a16b46b4d4144f79bdd9dd04a287c'.decode('hex')),
+               (40, 'dfa66747de9ae63030ca32611497c827'.decode('hex')),
+               (64, '51f0bebf7e3b9d92fc49741779363cfe'.decode('hex'))]
+    return all([aes3gpp.AES_CMAC(key, data[:l]) == mac for l, mac in outputs])
+
+def aes_EEA2_ctr_check():
+    # multi-blocks keystream checked against counter blocks ciphered in ECB
+    from CM import aes_ecb, xor_str
+    from struct import pack
+    aes3gpp = AES_3GPP()
+    key     = '\xd3\xc5\xd5\x922\x7f\xb1\x1c@5\xc6h\n\xf8\xc6\xd1'
+    count   = 0x398a59b4
+    bearer  = 0x15
+    direct  = 1
+    data    = ''.join(map(chr, range(256))) * 20
+    ctr     = ''.join([pack('!IIQ', count, (bearer<<27)+(direct<<26), i) \
+                       for i in range(len(data)/16)])
+    output  = xor_str(data, aes_ecb(key, ctr))
+    return aes3gpp.EEA2(key, count, bearer, direct, data) == output
+
+def aes_cmac_cache_check():
+    # repeated EIA2 with the same key must hit the key cache
+    aes3gpp = AES_3GPP()
+    aes3gpp.cmac_cache.clear()
+    key     = '5ead1f52e92ced3add9486d1b066c693'.decode('hex')
+    data    = '0010101010'.decode('hex')
+    macs    = [aes3gpp.EIA2(key, 0, 0, 0, data, 40) for i in range(3)]
+    return macs == 3*['c76c5132'.decode('hex')] and \
+           aes3gpp.cmac_cache.misses == 1 and aes3gpp.cmac_cache.hits == 2
+
+def aes_keystream_cache_check():
+    # EEA2 and SRB PDUs with the keystream cache enabled, against the same
+    # calls without cache: prefixes served from the cache, keystreams
+    # replaced when longer, least recently used ones evicted past the budget
+    from CM import KeystreamCache
+    aes3gpp = AES_3GPP()
+    key     = 'd3c5d592327fb11c4035c6680af8c6d1'.decode('hex')
+    data    = ''.join(map(chr, range(256))) * 4
+    args    = [(key, 0x398a59b4, 0x15, 1, data[:n]) for n in (40, 1000, 17, 1000, 0)] + \
+              [(key, i, 3, 0, data[:100]) for i in range(8)] + [(key, 0, 3, 0, data[:64])]
+    out     = [aes3gpp.EEA2(*arg) for arg in args]
+    srb     = aes3gpp.SRB_protect(key, key, 9, 3, 0, data[:30])
+    mac     = aes3gpp.EIA2(key, 9, 3, 0, data[:30])
+    AES_3GPP.keystream_cache = KeystreamCache(1024)
+    try:
+        out_cached = [aes3gpp.EEA2(*arg) for arg in args]
+        srb_cached = aes3gpp.SRB_protect(key, key, 9, 3, 0, data[:30])
+        check = aes3gpp.SRB_unprotect(key, key, 9, 3, 0, srb_cached)
+        cache = aes3gpp.keystream_cache
+        # 40 bytes keystream replaced by 1000 bytes, evicted by the 8 next
+        # 100 bytes ones, then 33 bytes for the SRB PDU
+        counters = (cache.hits, cache.misses, len(cache), cache.size)
+    finally:
+        AES_3GPP.keystream_cache = KeystreamCache(0)
+    return out_cached == out and srb_cached == srb and \
+           check == (data[:30], mac, True) and counters == (4, 11, 9, 833)
+
+def aes_EIA2_batch_check():
+    # batch MAC over messages from EIA2 testsets 1, 2 and 9, with per-message
+    # keys, and check of expected MACs (2nd expected MAC is wrong)
+    aes3gpp = AES_3GPP()
+    keys    = ['+\xd6E\x9f\x82\xc5\xb3\x00\x95,I\x10H\x81\xffH',
+               '\xd3\xc5\xd5\x922\x7f\xb1\x1c@5\xc6h\n\xf8\xc6\xd1',
+               '5ead1f52e92ced3add9486d1b066c693'.decode('hex')]
+    counts  = [0x38a6f056, 0x398a59b4, 0]
+    bearers = [0x18, 0x1a, 0]
+    directs = [0, 1, 0]
+    datas   = ['324bc98@', 'HE\x83\xd5\xaf\xe0\x82\xae',
+               '0010101010'.decode('hex')]
+    bitlens = [58, 64, 40]
+    output  = '\x11\x8cn\xb8\xb97\x87\xe6' + 'c76c5132'.decode('hex')
+    macs, check = aes3gpp.EIA2_batch(keys, counts, bearers, directs, datas,
+                                     bitlens, output[:4] + 4*'\0' + output[8:])
+    return macs == output and check == bytearray('\xa0')
+
+def aes_EEA2_batch_check():
+    # batch ciphering of data from EEA2 testsets 1 and 3, and EIA2 testset 11
+    aes3gpp = AES_3GPP()
+    keys    = ['\xd3\xc5\xd5\x922\x7f\xb1\x1c@5\xc6h\n\xf8\xc6\xd1',
+               '\n\x8bk\xd8\xd9\xb0\x8b\x08\xd6N2\xd1\x81ww\xfb',
+               'a24fd61d0b627b91f7451be11df4d40e'.decode('hex')]
+    counts  = [0x398a59b4, 0x544d49cd, 0x1C3]
+    bearers = [0x15, 0x4, 0x0]
+    directs = [1, 0, 1]
+    datas   = ['\x98\x1b\xa6\x82L\x1b\xfb\x1a\xb4\x85G )\xb7\x1d\x80\x8c\xe3>,\xc3\xc0\xb5\xfc\x1f=\xe8\xa6\xdcf\xb1\xf0',
+               '\xfd@\xa4\x1d7\n\x1fetP\x95h}G\xba\x1d6\xd24\x9e#\xf6D9,\x8e\xa9\xc4\x9d@\xc12q\xaf\xf2d\xd0\xf2H\x00',
+               '45e0003c4cce00003d014091ac144077ac1456e2'.decode('hex')]
+    bitlens = [253, 310, 160]
+    outputs = ['\xe9\xfe\xd8\xa6=\x15S\x04\xd7\x1d\xf2\x0b\xf3\xe8"\x14\xb2\x0e\xd7\xda\xd2\xf23\xdc<"\xd7\xbd\xee\xed\x8ex',
+               'uu\r7\xb4\xbb\xa2\xa4\xde\xdb4#[\xd6\x8cfE\xac\xda\xac\xa4\x818\xa3\xb0\xc4q\xe2\xa7\x04\x1aWd#\xd2\x92r\x87\xf0',
+               'ee1cae4f34904f46515bc173562021c64afe08fc'.decode('hex')]
+    out, offsets = aes3gpp.EEA2_batch(keys, counts, bearers, directs, datas,
+                                      bitlens)
+    # empty data, or truncated to nothing, alone or with other data
+    empty   = [aes3gpp.EEA2_batch(keys[0], [1], 0, 0, ['']),
+               aes3gpp.EEA2_batch(keys[0], [5], 1, 1, [datas[0]], [0]),
+               aes3gpp.EEA2_batch(keys[0], counts[1::-1], bearers[0], directs[0],
+                                  ['', datas[0]], [0, bitlens[0]])]
+    return [out[offsets[i]:offsets[i+1]] for i in range(3)] == outputs and \
+           empty == [('', [0, 0]), ('', [0, 0]), (outputs[0], [0, 0, 32])]
+
+def aes_stream_check():
+    # chunked EEA2 / EIA2 streams against one-shot EEA2 / EIA2
+    aes3gpp = AES_3GPP()
+    key     = '\xb3\x12\x0f\xfd\xb2\xcfj\xf4\xe7>\xaf.\xf4\xeb\xeci'
+    count   = 0x296f393c
+    bearer  = 0xb
+    direct  = 1
+    data    = ''.join(map(chr, range(256))) * 40 + 'abc'
+    bitlen  = len(data)*8 - 5
+    ciph    = aes3gpp.EEA2_stream(key, count, bearer, direct)
+    mac     = aes3gpp.EIA2_stream(key, count, bearer, direct)
+    out     = []
+    for i in range(0, len(data), 1000):
+        out.append(ciph.update(data[i:i+1000]))
+        mac.update(data[i:i+1000])
+    out.append(ciph.finalize())
+    return ''.join(out) == aes3gpp.EEA2(key, count, bearer, direct, data) and \
+           mac.finalize(bitlen) == \
+           aes3gpp.EIA2(key, count, bearer, direct, data, bitlen)
+
+def aes_cmac_chain_check():
+    # one-shot EIA2 of messages chained with the cached AES-ECB cipher or
+    # with AES-CBC (around cmac_chain_max), against EIA2 streams
+    aes3gpp = AES_3GPP()
+    key     = '\xb3\x12\x0f\xfd\xb2\xcfj\xf4\xe7>\xaf.\xf4\xeb\xeci'
+    data    = ''.join(map(chr, range(256)))
+    for n in range(120):
+        mac = aes3gpp.EIA2_stream(key, n, 3, 1)
+        mac.update(data[:n])
+        if mac.finalize() != aes3gpp.EIA2(key, n, 3, 1, data[:n]):
+            return False
+    return True
+
+def aes_srb_check():
+    # fused SRB protect / unprotect against EIA2 then EEA2
+    aes3gpp = AES_3GPP()
+    key_int = '\x5e\xad\x1f\x52\xe9\x2c\xed\x3a\xdd\x94\x86\xd1\xb0\x66\xc6\x93'
+    key_enc = '\xb3\x12\x0f\xfd\xb2\xcfj\xf4\xe7>\xaf.\xf4\xeb\xeci'
+    count   = 0x296f393c
+    bearer  = 0x1
+    direct  = 1
+    pdu     = '\x05' + ''.join(map(chr, range(100)))
+    mac     = aes3gpp.EIA2(key_int, count, bearer, direct, pdu)
+    out     = aes3gpp.SRB_protect(key_int, key_enc, count, bearer, direct, pdu)
+    return out == pdu[:1] + aes3gpp.EEA2(key_enc, count, bearer, direct, pdu[1:] + mac) and \
+           aes3gpp.SRB_unprotect(key_int, key_enc, count, bearer, direct, out) == \
+           (pdu, mac, True) and \
+           aes3gpp.SRB_unprotect(key_int, key_enc, count^1, bearer, direct, out)[2] == False
+
+def aes_thread_check():
+    # module EEA2 / EIA2 called from a pool of threads, with more keys than
+    # the CMAC cache holds, against the same calls made serially
+    from multiprocessing.pool import ThreadPool
+    from CM import EEA2, EIA2
+    args = [(pack('!IIQ', i % 7, i, 0), i, i % 32, i % 2,
+             ''.join(map(chr, range(i % 256))) * 3) for i in range(300)]
+    def run(arg):
+        return EEA2(*arg), EIA2(*arg)
+    AES_3GPP.cmac_cache.size = 4
+    try:
+        pool = ThreadPool(8)
+        out = pool.map(run, args, 1)
+        pool.close()
+        pool.join()
+    finally:
+        AES_3GPP.cmac_cache.size = 64
+    return out == map(run, args)
+
 def aes_testsets():
 
     return aes_EEA2_testset_1() & aes_EEA2_testset_2() & \
@@ -264,20 +444,18 @@ def aes_testsets():
             aes_EIA2_testset_5() & aes_EIA2_testset_6() & \
             aes_EIA2_testset_7() & aes_EIA2_testset_8() & \
             aes_EIA2_testset_9()& aes_EIA2_testset_10() & \
-            aes_EIA2_testset_11()& aes_EIA2_testset_12()
+            aes_EIA2_testset_11()& aes_EIA2_testset_12() & \
+            aes_EEA2_ctr_check() & aes_cmac_cache_check() & \
+            aes_CMAC_testset() & aes_EIA2_batch_check() & \
+            aes_EEA2_batch_check() & aes_stream_check() & \
+            aes_srb_check() & aes_thread_check() & \
+            aes_keystream_cache_check() & aes_cmac_chain_check()
 
 ###
 ###
 def testall():
     return aes_testsets()
 
-def testperf():
-    a = None
-    T0 = time()
-    for i in range(1000):
-        a = testall()
-    print('1000 full testsets in %.3f seconds' % (time()-T0, ))
-
 
 
 # print len(bytearray.fromhex('5ead1f52e92ced3add9486d1b066c693'))
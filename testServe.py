@@ -0,0 +1,70 @@
+__author__ = 'x37liu'
+import os
+import tempfile
+import threading
+from crypt_serve import CryptoServer, CryptoUnixServer, Client
+from wrapper import Cipher
+
+def start(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def stop(server, thread):
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+def test():
+    path = tempfile.mktemp()
+    server = CryptoUnixServer(path)
+    thread = start(server)
+    client = Client(path)
+
+    output = client.call({'id': 1, 'task': 'ip', 'key': '5ead1f52e92ced3add9486d1b066c693',
+                          'count': '0x00', 'direction': 'uplink', 'bearer': 0, 'data': '10101010'})
+    print "A: " + str(output == {'id': 1, 'out': 'aa795e00'})
+
+    # pipelined requests, answered in order
+    for i in range(200):
+        client.send({'id': i, 'task': 'ci', 'key': 'a24fd61d0b627b91f7451be11df4d40e',
+                     'count': 0x1C3, 'direction': 'downlink', 'bearer': 0,
+                     'data': '45e0003c4cce00003d014091ac144077ac1456e2'}, False)
+    output = [client.recv() for i in range(200)]
+    print "B: " + str(output == [{'id': i, 'out': 'ee1cae4f34904f46515bc173562021c64afe08fc'}
+                                 for i in range(200)])
+
+    # bulk request (processed by the executor) between small ones, invalid
+    # data included
+    data = os.urandom(1 << 17).encode('hex')
+    client.send({'id': 'a', 'task': 'de', 'key': 'a24fd61d0b627b91f7451be11df4d40e',
+                 'count': '1C3', 'direction': 'downlink', 'bearer': 0, 'data': data})
+    client.send({'id': 'b', 'task': 'xx'})
+    client.send({'id': 'c', 'task': 'ci', 'key': 'zz', 'count': 0, 'bearer': 0, 'data': ''})
+    client.send({'id': 'd', 'task': 'ci', 'key': 'a24fd61d0b627b91f7451be11df4d40e',
+                 'count': 0, 'bearer': 0, 'data': 5})
+    client.send({'id': 'e', 'task': 'ip', 'key': '5ead1f52e92ced3add9486d1b066c693',
+                 'count': 0, 'bearer': 0, 'data': '10101010'})
+    output = [client.recv() for i in range(5)]
+    print "C: " + str(output[0]['out'] == Cipher().decrypt('a24fd61d0b627b91f7451be11df4d40e', 0x1C3,
+                                                           'downlink', 0, data) and
+                      output[1:] == [{'id': 'b', 'error': 'Invalid request'},
+                                     {'id': 'c', 'error': 'Invalid request'},
+                                     {'id': 'd', 'error': 'Invalid request'},
+                                     {'id': 'e', 'out': 'aa795e00'}])
+    client.close()
+    stop(server, thread)
+
+    server = CryptoServer(('127.0.0.1', 0))
+    thread = start(server)
+    client = Client(server.server_address)
+    output = client.call({'id': 2, 'task': 'deip', 'key': '941c08ca34df130ee7644ef803b90eda',
+                          'ip_key': '5ead1f52e92ced3add9486d1b066c693', 'count': '1F',
+                          'direction': 'uplink', 'bearer': 3, 'data': '0374f48c6e579c2702'})
+    print "D: " + str(output == {'id': 2, 'out': '03aabbccdd', 'mac': 'df1ca29c', 'check': True})
+    client.close()
+    stop(server, thread)
+
+if __name__ == '__main__':
+    test()
@@ -1,4 +1,10 @@
 __author__ = 'x37liu'
+import os
+import mmap
+import tempfile
+import stats
+import hexcodec
+import wrapper
 from wrapper import Cipher
 def test():
     ci = Cipher()
@@ -18,4 +24,121 @@ def test():
     output = ci.decrypt('a24fd61d0b627b91f7451be11df4d40e', 0x1C3, 'downlink', 0, 'ee1cae4f34904f46515bc173562021c64afe08fc')
     print "E: " + str(output == '45e0003c4cce00003d014091ac144077ac1456e2')
 
+    output = ci.IP_batch('5ead1f52e92ced3add9486d1b066c693', [0x00, 0x01], 'uplink', 0,
+                         ['0010101010', '0010101010'], ['c76c5132', 'c76c5132'])
+    print "F: " + str(output[0][0] == 'c76c5132' and output[1] == [True, False])
+
+    output = ci.decrypt_batch('a24fd61d0b627b91f7451be11df4d40e', [0x1C3, 0x1C3], 'downlink', 0,
+                              ['ee1cae4f34904f46515bc173562021c64afe08fc', 'ee1cae4f'])
+    print "G: " + str(output == ['45e0003c4cce00003d014091ac144077ac1456e2', '45e0003c'])
+
+    inPath = tempfile.mktemp()
+    outPath = tempfile.mktemp()
+    inFile = open(inPath, 'w')
+    inFile.write('0x45e0003c4cce0000\n3d014091ac144077ac1456e2\n')
+    inFile.close()
+    ci.encrypt_mmap('a24fd61d0b627b91f7451be11df4d40e', 0x1C3, 'downlink', 0, inPath, outPath,
+                    outFormat = 'bin')
+    output = open(outPath, 'rb').read().encode('hex')
+    # several windows, then invalid hex at the end: truncated to what was written
+    mapSize = wrapper.MAP_SIZE
+    wrapper.MAP_SIZE = mmap.ALLOCATIONGRANULARITY
+    data = os.urandom(3*mmap.ALLOCATIONGRANULARITY + 5).encode('hex')
+    inFile = open(inPath, 'w')
+    inFile.write(data)
+    inFile.close()
+    ci.encrypt_mmap('a24fd61d0b627b91f7451be11df4d40e', 0x1C3, 'downlink', 0, inPath, outPath)
+    windows = open(outPath, 'rb').read() == ci.encrypt('a24fd61d0b627b91f7451be11df4d40e', 0x1C3,
+                                                       'downlink', 0, data)
+    inFile = open(inPath, 'a')
+    inFile.write('zz')
+    inFile.close()
+    try:
+        ci.encrypt_mmap('a24fd61d0b627b91f7451be11df4d40e', 0x1C3, 'downlink', 0, inPath, outPath,
+                        outFormat = 'bin')
+        windows = False
+    except (TypeError, ValueError):
+        windows = windows and os.path.getsize(outPath) < len(data)//2
+    wrapper.MAP_SIZE = mapSize
+    os.remove(inPath)
+    os.remove(outPath)
+    print "H: " + str(output == 'ee1cae4f34904f46515bc173562021c64afe08fc' and windows)
+
+    output = ci.SRB_protect('5ead1f52e92ced3add9486d1b066c693', '941c08ca34df130ee7644ef803b90eda',
+                            0x1F, 'uplink', 3, '03aabbccdd')
+    mac = ci.IP('5ead1f52e92ced3add9486d1b066c693', 0x1F, 'uplink', 3, '03aabbccdd')
+    check = ci.SRB_unprotect('5ead1f52e92ced3add9486d1b066c693', '941c08ca34df130ee7644ef803b90eda',
+                             0x1F, 'uplink', 3, output)
+    print "I: " + str(output == '03' + ci.encrypt('941c08ca34df130ee7644ef803b90eda', 0x1F, 'uplink', 3,
+                                                  'aabbccdd' + mac) and
+                      check == ('03aabbccdd', mac, True))
+
+    # instrumentation, counting and then restoring the original functions
+    encrypt = Cipher.__dict__['encrypt']
+    stats.enable()
+    stats.reset()
+    output = ci.encrypt('d3c5d592327fb11c4035c6680af8c6d1', 0x398a59b4, 'downlink', 0x15,
+                        '981ba6824c1bfb1ab485472029b71d808ce33e2cc3c0b5fc1f3de8a6dc66b1f0')
+    counters = stats.snapshot()
+    stats.disable()
+    print "J: " + str(output == 'e9fed8a63d155304d71df20bf3e82214b20ed7dad2f233dc3c22d7bdeeed8e78' and
+                      counters['Cipher.encrypt'] == {'calls': 1, 'bytes': 32,
+                                                     'seconds': counters['Cipher.encrypt']['seconds']} and
+                      counters['AES-CTR']['bytes'] == 32 and
+                      Cipher.__dict__['encrypt'] is encrypt and not stats.enabled)
+
+    # bytes API, from bytes, bytearray or memoryview into an output buffer
+    key = '941c08ca34df130ee7644ef803b90eda'.decode('hex')
+    data = bytearray(('00' + 'aabbccdd'*64 + '00').decode('hex'))
+    out = bytearray(len(data))
+    size = ci.encrypt_bytes(key, 0x1F, 'uplink', 3, memoryview(data)[1:-1],
+                            memoryview(out)[1:])
+    hexOut = ci.encrypt('941c08ca34df130ee7644ef803b90eda', 0x1F, 'uplink', 3, 'aabbccdd'*64)
+    output = ci.decrypt_bytes(bytearray(key), 0x1F, 'uplink', 3, buffer(out, 1, size))
+    print "K: " + str(size == 256 and out[1:-1] == bytearray(hexOut.decode('hex')) and
+                      output == data[1:-1] and
+                      ci.IP_bytes(key, 0x1F, 'uplink', 3, data[1:-1]).encode('hex') ==
+                      ci.IP('941c08ca34df130ee7644ef803b90eda', 0x1F, 'uplink', 3, 'aabbccdd'*64))
+
+    # hex codec: 0x prefixes at token starts, whitespace and line breaks,
+    # in one go or in chunks cut anywhere, small or big
+    text = '0x0123 4567\r\n0X89ab\tcdef\n'
+    output = [hexcodec.decode(text), hexcodec.decode(u'0x0123456789ABCDEF')]
+    output += [''.join(hexcodec.decodeChunks([text[:i], text[i:j], text[j:]]))
+               for i in range(len(text)) for j in range(i, len(text))]
+    big = os.urandom(1 << 16)
+    text = '\n'.join(['0x' + hexcodec.encode(big[i:i+32]) for i in range(0, len(big), 32)])
+    errors = 0
+    for bad in ['01230x4567', '0123 456', '0123 45z7', 'x0123']:
+        try:
+            hexcodec.decode(bad)
+        except TypeError:
+            errors += 1
+    print "L: " + str(output == ['0123456789abcdef'.decode('hex')]*len(output) and
+                      hexcodec.decode(text) == big and
+                      hexcodec.decode(' \r\n'*(1 << 15)) == '' and
+                      ''.join(hexcodec.decodeChunks([text[:9999], text[9999:]])) == big and
+                      errors == 4)
+
+    # one meaning of the direction in all methods: 'uplink' or 0, 'downlink'
+    # or 1, anything else refused
+    key = '941c08ca34df130ee7644ef803b90eda'
+    outs = [[ci.encrypt(key, 0x1F, direct, 3, 'aabbccdd'),
+             ci.encrypt_batch(key, [0x1F], direct, 3, ['aabbccdd'])[0],
+             ''.join(ci.encrypt_chunks(key, 0x1F, direct, 3, ['\xaa\xbb\xcc\xdd'])).encode('hex'),
+             ci.SRB_protect(key, key, 0x1F, direct, 3, '00aabbccdd')[2:10],
+             ci.IP(key, 0x1F, direct, 3, 'aabbccdd'),
+             ci.IP_batch(key, [0x1F], direct, 3, ['aabbccdd'])[0],
+             ci.IP_chunks(key, 0x1F, direct, 3, ['\xaa\xbb\xcc\xdd'])]
+            for direct in ('uplink', 'downlink', 0, 1)]
+    errors = 0
+    for direct in ('Uplink', 2, None):
+        try:
+            ci.encrypt(key, 0x1F, direct, 3, 'aabbccdd')
+        except ValueError:
+            errors += 1
+    print "M: " + str(all([len(set(out[:4])) == 1 and len(set(out[4:])) == 1 for out in outs]) and
+                      outs[0] != outs[1] and outs[0] == outs[2] and outs[1] == outs[3] and
+                      errors == 3)
+
 test()
\ No newline at end of file
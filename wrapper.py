@@ -1,49 +1,274 @@
 __author__ = 'x37liu'
+import os
+import mmap
 from CM import AES_3GPP
+from hexcodec import BUF_SIZE, decode as fromHex, encode as toHex, decodeFile as readHex
+
+# size of the windows of the memory-mapped files (a multiple of
+# mmap.ALLOCATIONGRANULARITY), only one being mapped at a time
+MAP_SIZE = 16 << 20
+
+class MappedFile:
+    # read-only file object over the file src of size bytes, mapped window
+    # after window, so that the resident memory does not grow with the file
+    def __init__(self, src, size, window=None):
+        self.fileno = src.fileno()
+        self.size = size
+        self.window = window or MAP_SIZE
+        self.map = None
+        self.offset = 0
+        self.pos = 0
+
+    def read(self, n):
+        if self.pos >= self.size:
+            self.close()
+            return ''
+        if self.map is None or self.pos >= self.offset + len(self.map):
+            self.close()
+            self.offset = self.pos - self.pos % mmap.ALLOCATIONGRANULARITY
+            self.map = mmap.mmap(self.fileno, min(self.window, self.size - self.offset),
+                                 access=mmap.ACCESS_READ, offset=self.offset)
+        start = self.pos - self.offset
+        data = self.map[start:start+n]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+class MappedWriter:
+    # write-only file object over the file dst, preallocated to size bytes
+    # and mapped window after window
+    def __init__(self, dst, size, window=None):
+        self.fileno = dst.fileno()
+        self.size = size
+        self.window = window or MAP_SIZE
+        self.map = None
+        self.offset = 0
+        self.pos = 0
+
+    def write(self, data):
+        while data:
+            if self.map is None or self.pos >= self.offset + len(self.map):
+                self.close()
+                self.offset = self.pos - self.pos % mmap.ALLOCATIONGRANULARITY
+                self.map = mmap.mmap(self.fileno, min(self.window, self.size - self.offset),
+                                     offset=self.offset)
+            start = self.pos - self.offset
+            n = min(len(data), len(self.map) - start)
+            self.map[start:start+n] = data[:n]
+            data = data[n:]
+            self.pos += n
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+
+def toBuffer(data):
+    # bytes, bytearray or memoryview data as a string or read-only buffer,
+    # that AES_3GPP takes without copy (but for memoryviews, which pycrypto
+    # does not take)
+    if isinstance(data, (str, buffer)):
+        return data
+    if isinstance(data, bytearray):
+        return buffer(data)
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    raise TypeError('bytes, bytearray or memoryview expected')
+
+def direction(direct):
+    # 0 for 'uplink', 1 for 'downlink', integers having the CM meaning
+    # (0 uplink, 1 downlink)
+    if direct == 'uplink' or direct == 0:
+        return 0
+    if direct == 'downlink' or direct == 1:
+        return 1
+    raise ValueError('Invalid direction %r' % (direct,))
+
+def readBin(src, bufsize=BUF_SIZE):
+    # yield raw binary chunks from the file object src
+    while True:
+        chunk = src.read(bufsize)
+        if not chunk:
+            break
+        yield chunk
+
+def readData(src, format='hex', bufsize=BUF_SIZE):
+    # yield binary chunks from src, holding hex ('hex') or raw ('bin') data
+    if format == 'bin':
+        return readBin(src, bufsize)
+    return readHex(src, bufsize)
 
 class Cipher:
     def __init__(self ):
         self.cipher = AES_3GPP()
 
     def IP(self, key, count, direct, bearer, data):
-        if "0x" in key:
-            key = key.replace('0x', '')
-        key = key.decode('hex')
-        if direct == 'uplink':
-            direct = 0
+        return toHex(self.IP_bytes(fromHex(key), count, direct, bearer, fromHex(data)))
+
+    def IP_bytes(self, key, count, direct, bearer, data):
+        # 4 bytes MAC-I of the bytes-like data, with the 16 bytes key
+        return self.cipher.EIA2(str(toBuffer(key)), count, bearer, direction(direct),
+                                str(toBuffer(data)))
+
+    def IP_batch(self, key, counts, direct, bearer, datas, macs=None):
+        key = fromHex(key)
+        direct = direction(direct)
+        datas = [fromHex(data) for data in datas]
+        if macs is None:
+            out = self.cipher.EIA2_batch(key, counts, bearer, direct, datas)
         else:
-            direct = 1
-        if '0x' in data:
-            data = data.replace('0x', '')
-        data = data.decode('hex')
-        bitLen = len(data)*8
-        return self.cipher.EIA2(key, count, bearer, direct, data, bitLen).encode('hex')
+            macs = fromHex(''.join(macs))
+            out, check = self.cipher.EIA2_batch(key, counts, bearer, direct, datas,
+                                                None, macs)
+        out = toHex(out)
+        out = [out[i:i+8] for i in range(0, len(out), 8)]
+        if macs is None:
+            return out
+        return out, [bool(check[i>>3] & (0x80 >> (i&7))) for i in range(len(out))]
 
     def encrypt(self,key, count, direct, bearer, data):
-        if '0x' in key:
-            key = key.replace('0x', '')
-        key = key.decode('hex')
-        if direct == 'uplink':
-            direct = 0
+        return toHex(self.encrypt_bytes(fromHex(key), count, direct, bearer, fromHex(data)))
+
+    def encrypt_bytes(self, key, count, direct, bearer, data, out=None):
+        # cipher the bytes-like data with the 16 bytes key, returns the
+        # ciphered string, or writes it at the start of the writable buffer
+        # out (bytearray or memoryview) and returns its length
+        ciph = self.cipher.EEA2(str(toBuffer(key)), count, bearer, direction(direct),
+                                toBuffer(data))
+        if out is None:
+            return ciph
+        if len(out) < len(ciph):
+            raise ValueError('Output buffer too small')
+        out[:len(ciph)] = ciph
+        return len(ciph)
+
+    def decrypt_bytes(self, key, count, direct, bearer, data, out=None):
+        return self.encrypt_bytes(key, count, direct, bearer, data, out)
+
+    def encrypt_batch(self, key, counts, direct, bearer, datas):
+        key = fromHex(key)
+        direct = direction(direct)
+        datas = [fromHex(data) for data in datas]
+        out, offsets = self.cipher.EEA2_batch(key, counts, bearer, direct, datas)
+        out = toHex(out)
+        return [out[2*offsets[i]:2*offsets[i+1]] for i in range(len(datas))]
+
+    def decrypt_batch(self, key, counts, direct, bearer, datas):
+        return self.encrypt_batch(key, counts, direct, bearer, datas)
+
+    def IP_file(self, key, count, direct, bearer, src, bufsize=BUF_SIZE, format='hex'):
+        return self.IP_chunks(key, count, direct, bearer, readData(src, format, bufsize))
+
+    def IP_chunks(self, key, count, direct, bearer, chunks):
+        # integrity check of the binary chunks iterable
+        key = fromHex(key)
+        direct = direction(direct)
+        mac = self.cipher.EIA2_stream(key, count, bearer, direct)
+        for data in chunks:
+            mac.update(data)
+        return toHex(mac.finalize())
+
+    def encrypt_file(self, key, count, direct, bearer, src, dst, bufsize=BUF_SIZE,
+                     inFormat='hex', outFormat='hex'):
+        for data in self.encrypt_chunks(key, count, direct, bearer,
+                                        readData(src, inFormat, bufsize)):
+            if outFormat == 'hex':
+                data = toHex(data)
+            dst.write(data)
+
+    def decrypt_file(self, key, count, direct, bearer, src, dst, bufsize=BUF_SIZE,
+                     inFormat='hex', outFormat='hex'):
+        self.encrypt_file(key, count, direct, bearer, src, dst, bufsize,
+                          inFormat, outFormat)
+
+    def IP_mmap(self, key, count, direct, bearer, inPath, bufsize=BUF_SIZE,
+                inFormat='hex'):
+        src = open(inPath, 'rb')
+        try:
+            if not os.path.getsize(inPath):
+                return self.IP_file(key, count, direct, bearer, src, bufsize, inFormat)
+            inFile = MappedFile(src, os.path.getsize(inPath))
+            try:
+                return self.IP_file(key, count, direct, bearer, inFile, bufsize,
+                                    inFormat)
+            finally:
+                inFile.close()
+        finally:
+            src.close()
+
+    def encrypt_mmap(self, key, count, direct, bearer, inPath, outPath,
+                     bufsize=BUF_SIZE, inFormat='hex', outFormat='hex'):
+        # cipher inPath into outPath, both memory-mapped and processed
+        # window after window, outPath being preallocated to its maximum size
+        # and truncated to what was written, even on error
+        size = os.path.getsize(inPath)
+        if inFormat == outFormat:
+            outSize = size
+        elif inFormat == 'hex':
+            outSize = size//2
         else:
-            direct = 1
-        if '0x' in data:
-            data = data.replace('0x', '')
-        data = data.decode('hex')
-        bitLen = len(data)*8
-        return self.cipher.EEA2(key, count, bearer, direct, data, bitLen).encode('hex')
+            outSize = 2*size
+        src = open(inPath, 'rb')
+        dst = open(outPath, 'w+b')
+        try:
+            if not size or not outSize:
+                self.encrypt_file(key, count, direct, bearer, src, dst, bufsize,
+                                  inFormat, outFormat)
+                return
+            dst.truncate(outSize)
+            inFile = MappedFile(src, size)
+            outFile = MappedWriter(dst, outSize)
+            try:
+                for data in self.encrypt_chunks(key, count, direct, bearer,
+                                                readData(inFile, inFormat, bufsize)):
+                    if outFormat == 'hex':
+                        data = toHex(data)
+                    outFile.write(data)
+            finally:
+                outFile.close()
+                inFile.close()
+                dst.truncate(outFile.pos)
+        finally:
+            src.close()
+            dst.close()
+
+    def decrypt_mmap(self, key, count, direct, bearer, inPath, outPath,
+                     bufsize=BUF_SIZE, inFormat='hex', outFormat='hex'):
+        self.encrypt_mmap(key, count, direct, bearer, inPath, outPath, bufsize,
+                          inFormat, outFormat)
+
+    def encrypt_chunks(self, key, count, direct, bearer, chunks):
+        # yield ciphered binary chunks from the binary chunks iterable
+        key = fromHex(key)
+        direct = direction(direct)
+        ciph = self.cipher.EEA2_stream(key, count, bearer, direct)
+        for data in chunks:
+            yield ciph.update(data)
+
+    def SRB_protect(self, key_IP, key_SRB, count, direct, bearer, data):
+        # MAC-I of the PDU data, then ciphering of the PDU payload and MAC-I,
+        # the 1 byte header being kept in clear
+        key_IP = fromHex(key_IP)
+        key_SRB = fromHex(key_SRB)
+        direct = direction(direct)
+        data = fromHex(data)
+        return toHex(self.cipher.SRB_protect(key_IP, key_SRB, count, bearer, direct, data))
+
+    def SRB_unprotect(self, key_IP, key_SRB, count, direct, bearer, data):
+        # returns the deciphered PDU (without MAC-I), its MAC-I, and whether
+        # the MAC-I is valid
+        key_IP = fromHex(key_IP)
+        key_SRB = fromHex(key_SRB)
+        direct = direction(direct)
+        data = fromHex(data)
+        out, mac, check = self.cipher.SRB_unprotect(key_IP, key_SRB, count, bearer, direct, data)
+        return toHex(out), toHex(mac), check
 
     def decrypt(self,key, count, direct, bearer, data):
-        if '0x' in key:
-            key = key.replace('0x', '')
-        key = key.decode('hex')
-        if direct == 'uplink':
-            direct = 0
-        else:
-            direct = 1
-        if '0x' in data:
-            data = data.replace('0x', '')
-        data = data.decode('hex')
-        bitLen = len(data)*8
-        return self.cipher.EEA2(key, count, bearer, direct, data, bitLen).encode('hex')
+        return toHex(self.decrypt_bytes(fromHex(key), count, direct, bearer, fromHex(data)))
 